@@ -0,0 +1,273 @@
+import os
+import os.path
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterable, NamedTuple, Optional
+
+from moerderspiel import config
+from moerderspiel.util import file_lock
+
+# The subdirectories of CACHE_DIRECTORY whose files are tracked and evicted
+MANAGED_DIRECTORIES = ['mission-sheets', 'graphs']
+
+# Files that were used this recently are never evicted, because a request may be about to send them
+MIN_AGE = 60
+
+# The number of manifest entries that are kept in memory in front of the index
+MANIFEST_MEMORY_SIZE = 65536
+
+_local = threading.local()
+_manifest: Dict[str, str] = {}
+
+
+class SweepResult(NamedTuple):
+    files: int
+    size: int
+
+
+def index_path() -> str:
+    return os.path.join(config.CACHE_DIRECTORY, 'cache.sqlite')
+
+
+def _connection() -> sqlite3.Connection:
+    """
+    The connection to the cache index of the current thread. The index is a separate SQLite database in the cache
+    directory, so that it is shared by all processes using the same cache.
+    """
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        os.makedirs(config.CACHE_DIRECTORY, exist_ok=True)
+        connection = sqlite3.connect(index_path(), timeout=config.SQLITE_BUSY_TIMEOUT / 1000, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                           '(path TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_entries_accessed ON entries (accessed)')
+        connection.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value NUMERIC NOT NULL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS manifest (key TEXT PRIMARY KEY, path TEXT NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_manifest_path ON manifest (path)')
+        _local.connection = connection
+    return connection
+
+
+@contextmanager
+def _transaction():
+    connection = _connection()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+
+
+def _key(path: str) -> Optional[str]:
+    """
+    The path relative to the cache directory, or None if the file is not in a managed directory.
+    """
+    key = os.path.relpath(os.path.abspath(path), os.path.abspath(config.CACHE_DIRECTORY))
+    return key if key.split(os.sep)[0] in MANAGED_DIRECTORIES else None
+
+
+def touch(paths: Iterable[str], hit: bool = True) -> None:
+    """
+    Record that the given cache files were used, either as cache hits or as freshly rendered files (misses).
+    """
+    now = time.time()
+    rows = []
+    counters = Counter()
+    for path in paths:
+        key = _key(path)
+        if key is None:
+            continue
+        try:
+            rows.append((key, os.path.getsize(path), now))
+        except OSError:
+            continue
+        counters[f"{key.split(os.sep)[0]}.{'hits' if hit else 'misses'}"] += 1
+
+    if rows:
+        with _transaction() as connection:
+            connection.executemany('INSERT INTO entries (path, size, accessed) VALUES (?, ?, ?) '
+                                   'ON CONFLICT (path) DO UPDATE SET size = excluded.size, accessed = excluded.accessed',
+                                   rows)
+            connection.executemany('INSERT INTO state (name, value) VALUES (?, ?) '
+                                   'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+                                   counters.items())
+
+
+def scan() -> int:
+    """
+    Add the files in the managed directories that are not in the index yet, using their modification time as access
+    time, and remove index entries whose files are gone. Returns the number of added files.
+    """
+    files = {}
+    for directory in MANAGED_DIRECTORIES:
+        for root, _, names in os.walk(os.path.join(config.CACHE_DIRECTORY, directory)):
+            for name in names:
+                if name.endswith(('.lock', '.tmp', '.timeout')):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[_key(path)] = (stat.st_size, stat.st_mtime)
+
+    with _transaction() as connection:
+        known = {path for path, in connection.execute('SELECT path FROM entries')}
+        connection.executemany('DELETE FROM entries WHERE path = ?', [(path,) for path in known - files.keys()])
+        connection.executemany('INSERT INTO entries (path, size, accessed) VALUES (?, ?, ?)',
+                               [(path, *files[path]) for path in files.keys() - known])
+    return len(files.keys() - known)
+
+
+def sweep(max_size: int = None, max_age: float = None) -> SweepResult:
+    """
+    Evict the least recently used files until the cache is at most max_size bytes large, and all files that were not
+    used for max_age seconds.
+    """
+    max_size = config.CACHE_MAX_SIZE if max_size is None else max_size
+    max_age = config.CACHE_MAX_AGE if max_age is None else max_age
+    now = time.time()
+
+    with _transaction() as connection:
+        total, = connection.execute('SELECT coalesce(sum(size), 0) FROM entries').fetchone()
+        evicted = []
+        for path, size, accessed in connection.execute('SELECT path, size, accessed FROM entries '
+                                                       'ORDER BY accessed').fetchall():
+            if now - accessed < MIN_AGE or (total <= max_size and now - accessed <= max_age):
+                break
+
+            # Take the lock that renderers hold while writing the file, and skip files that are being rendered right
+            # now. The lock file is removed afterwards by remove_orphaned_files().
+            file = os.path.join(config.CACHE_DIRECTORY, path)
+            with file_lock(f"{file}.lock", blocking=False) as locked:
+                if not locked:
+                    continue
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+            evicted.append((path, size))
+            total -= size
+
+        connection.executemany('DELETE FROM entries WHERE path = ?', [(path,) for path, _ in evicted])
+        connection.executemany('DELETE FROM manifest WHERE path = ?', [(path,) for path, _ in evicted])
+        connection.execute("INSERT INTO state (name, value) VALUES ('last_sweep', ?) "
+                           "ON CONFLICT (name) DO UPDATE SET value = excluded.value", (now,))
+
+    remove_orphaned_files(now)
+    return SweepResult(files=len(evicted), size=sum(size for _, size in evicted))
+
+
+def remove_orphaned_files(now: float) -> None:
+    """
+    Remove the lock files and timeout markers in the managed directories whose cache file is gone, e.g. because it
+    was evicted. Lock files are only removed while holding them, and only if they were created more than MIN_AGE
+    seconds ago. At worst, a process that opened the lock file just before it was removed renders the same file as
+    another process, which is harmless because cache files are written atomically.
+    """
+    for directory in MANAGED_DIRECTORIES:
+        for root, _, names in os.walk(os.path.join(config.CACHE_DIRECTORY, directory)):
+            for name in names:
+                if not name.endswith(('.lock', '.timeout')):
+                    continue
+                path = os.path.join(root, name)
+                target = os.path.splitext(path)[0]
+                try:
+                    if os.path.exists(target) or now - os.path.getmtime(path) < MIN_AGE:
+                        continue
+                except FileNotFoundError:
+                    continue
+
+                try:
+                    if name.endswith('.timeout'):
+                        os.remove(path)
+                        continue
+                    with file_lock(path, blocking=False) as locked:
+                        if locked and not os.path.exists(target):
+                            os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def maybe_sweep() -> Optional[SweepResult]:
+    """
+    Sweep the cache if the last sweep of any process was more than CACHE_SWEEP_INTERVAL seconds ago. This is cheap
+    enough to be called after every render.
+    """
+    with _transaction() as connection:
+        row = connection.execute("SELECT value FROM state WHERE name = 'last_sweep'").fetchone()
+        if row and time.time() - row[0] < config.CACHE_SWEEP_INTERVAL:
+            return None
+        # Claim this sweep, so that concurrent renders in other processes don't start one as well
+        connection.execute("INSERT INTO state (name, value) VALUES ('last_sweep', ?) "
+                           "ON CONFLICT (name) DO UPDATE SET value = excluded.value", (time.time(),))
+    return sweep()
+
+
+def lookup(keys: Iterable[str]) -> Dict[str, str]:
+    """
+    Look up the files that were recorded for the given manifest keys with remember(). Keys whose files have been
+    evicted in the meantime are left out.
+    """
+    found = {}
+    missing = []
+    for key in keys:
+        if key in _manifest:
+            found[key] = _manifest[key]
+        else:
+            missing.append(key)
+
+    connection = _connection()
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        found.update(connection.execute(f"SELECT key, path FROM manifest WHERE key IN ({', '.join('?' * len(chunk))})",
+                                        chunk))
+
+    result = {}
+    for key, path in found.items():
+        path = os.path.join(config.CACHE_DIRECTORY, path)
+        if os.path.exists(path):
+            result[key] = path
+        else:
+            _manifest.pop(key, None)
+    remember(result, persist=False)
+    return result
+
+
+def remember(files: Dict[str, str], persist: bool = True) -> None:
+    """
+    Record the file for each of the given manifest keys, so that the file can be found without computing the
+    parameters it was rendered from.
+    """
+    if len(_manifest) + len(files) > MANIFEST_MEMORY_SIZE:
+        _manifest.clear()
+    rows = [(key, os.path.relpath(os.path.abspath(path), os.path.abspath(config.CACHE_DIRECTORY)))
+            for key, path in files.items()]
+    _manifest.update(rows)
+
+    if persist and rows:
+        with _transaction() as connection:
+            connection.executemany('INSERT INTO manifest (key, path) VALUES (?, ?) '
+                                   'ON CONFLICT (key) DO UPDATE SET path = excluded.path', rows)
+
+
+def statistics() -> Dict[str, int]:
+    """
+    The hit and miss counters, and the number and total size of the tracked files of each managed directory.
+    """
+    connection = _connection()
+    result = {name: int(value) for name, value in connection.execute("SELECT name, value FROM state "
+                                                                    "WHERE name != 'last_sweep' ORDER BY name")}
+    for directory in MANAGED_DIRECTORIES:
+        files, size = connection.execute('SELECT count(*), coalesce(sum(size), 0) FROM entries '
+                                         'WHERE path LIKE ?', (f"{directory}{os.sep}%",)).fetchone()
+        result[f"{directory}.files"] = files
+        result[f"{directory}.size"] = size
+    return result
@@ -2,14 +2,19 @@ import argparse
 import datetime
 from typing import List
 
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 
+import moerderspiel.cache as cache
 import moerderspiel.config as config
 import moerderspiel.graph as graph
+import moerderspiel.jobs as jobs
 import moerderspiel.pdf as pdf
 import moerderspiel.testgame as testgame
-from moerderspiel.db import Game, Circle, Player, Mission, database_transaction
+import moerderspiel.wordgen as wordgen
+from moerderspiel.db import Game, Circle, Player, Mission, GameStatistics, database_transaction, init_database
 from moerderspiel.game import GameService, GameError
+from moerderspiel.wordgen import SecretCodeScheme
 
 
 def error(message: str):
@@ -18,9 +23,9 @@ def error(message: str):
 
 
 def create_game(session: Session, game: str, title: str, circle: List[str], password: str,
-                endtime: datetime.datetime, **kwargs):
+                endtime: datetime.datetime, code_scheme: SecretCodeScheme, **kwargs):
     GameService.create_new_game(session=session, id=game, title=title, gamemaster_password=password, endtime=endtime,
-                                circles=circle)
+                                circles=circle, code_scheme=code_scheme)
 
 
 def add_player(game: Game, name: str, circle: List[str], **kwargs):
@@ -35,17 +40,65 @@ def start_game(game: Game, **kwargs):
     GameService(game).start_game()
 
 
-def generate_mission_sheets(game: Game, **kwargs):
-    print(pdf.generate_game_mission_sheets(game))
+def link_missions(game: Game, **kwargs):
+    if not game.started:
+        raise GameError("Game has not been started yet")
 
+    service = GameService(game)
+    for circle in game.circles:
+        service.link_circle(circle)
 
-def generate_graph(game: Game, circle: List[str], **kwargs):
+
+def store_mission_codes(game: Game, **kwargs):
+    if not game.started:
+        raise GameError("Game has not been started yet")
+
+    GameService(game).generate_mission_codes(missing_only=True)
+
+
+def rebuild_stats(game: Game, **kwargs):
+    GameStatistics.rebuild(game)
+
+
+def generate_mission_sheets(game: Game, workers: int, **kwargs):
+    print(pdf.generate_game_mission_sheets(game, workers=workers))
+
+
+def init_db(**kwargs):
+    init_database()
+
+
+def compile_wordgen_table(**kwargs):
+    print(wordgen.WordGenerator.compile_table(config.WORDGEN_CORPUS))
+
+
+def build_latex_format(**kwargs):
+    print(pdf.build_mission_sheet_format())
+
+
+def cache_gc(max_size: int, max_age: float, **kwargs):
+    print(f"Indexed {cache.scan()} untracked files")
+    result = cache.sweep(max_size=max_size, max_age=max_age)
+    print(f"Removed {result.files} files ({result.size} bytes)")
+    for name, value in cache.statistics().items():
+        print(f"{name}: {value}")
+
+
+def worker(concurrency: int, once: bool, **kwargs):
+    jobs.run_worker(concurrency=concurrency, once=once)
+
+
+def generate_graph(game: Game, circle: List[str], engine: str, compact: bool, timeout: float, **kwargs):
     if circle:
         circles = [Circle.by_game_and_name(game, c) for c in circle]
     else:
         circles = game.circles
 
-    graph.generate_circles_graph(circles)
+    try:
+        print(graph.generate_circles_graph(circles, show_original_owners=game.ended, engine=engine, compact=compact,
+                                           timeout=timeout))
+    except graph.GraphRenderTimeout as e:
+        error(str(e))
 
 
 def record_murder(game: Game, killer: str, victim: str, circle: str, reason: str, when: datetime.datetime,
@@ -55,14 +108,55 @@ def record_murder(game: Game, killer: str, victim: str, circle: str, reason: str
 
 
 def get_missions(game: Game, player: str = None, circle: str = None, **kwargs):
-    players = [Player.by_game_and_name(game, player)] if player else Player.by_game(game)
-    circles = [Circle.by_game_and_name(game, player)] if circle else Circle.by_game(game)
+    for assignment in Mission.current_assignments_in_game(game):
+        if (not player or assignment.owner.name == player) and (not circle or assignment.circle.name == circle):
+            print(f"{assignment.owner.name} in {assignment.circle.name}: {assignment.target.name}")
+
+
+def explain_queries(session: Session, game: Game, **kwargs):
+    if session.bind.dialect.name != 'sqlite':
+        error("Query plans can only be explained for SQLite databases")
+
+    circle = game.circles[0] if game.circles else None
+    player = game.players[0] if game.players else None
+
+    # Queries that need a circle or player are None if the game has none
+    queries = {
+        'Mission.by_victim_in_circle': (lambda: Mission.by_victim_in_circle(player, circle)) if player and circle else None,
+        'Mission.achievable_missions_in_circle': (lambda: Mission.achievable_missions_in_circle(circle)) if circle else None,
+        'Mission.completed_missions_in_game': lambda: Mission.completed_missions_in_game(game),
+        'Mission.current_assignments_in_game': lambda: Mission.current_assignments_in_game(game),
+        'Mission.by_killer': (lambda: Mission.by_killer(player)) if player else None,
+        'Mission.mass_murderers_by_game': lambda: Mission.mass_murderers_by_game(game),
+        'Player.victim_missions': (lambda: player.victim_missions) if player else None,
+        'Player.by_game': lambda: Player.by_game(game),
+        'Circle.by_game': lambda: Circle.by_game(game),
+    }
+
+    connection = session.connection()
+    for name, query in queries.items():
+        if query is None:
+            print(f"{name}: not applicable, the game has no circles or players")
+            print()
+            continue
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        session.expire_all()
+        event.listen(connection, 'before_cursor_execute', capture)
+        try:
+            query()
+        finally:
+            event.remove(connection, 'before_cursor_execute', capture)
 
-    for player in players:
-        for circle in circles:
-            mission = Mission.by_current_owner_in_circle(player, circle)
-            if mission:
-                print(f"{player.name} in {circle.name}: {mission.victim.name}")
+        print(f"{name}:")
+        for statement, parameters in statements:
+            for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters):
+                print(f"    {row[-1]}")
+        print()
 
 
 def create_test_game(session: Session, game: str, password: str, players: int, circles: int,
@@ -83,15 +177,20 @@ def create_test_game(session: Session, game: str, password: str, players: int, c
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--db', type=str, help='The database URI, defaults to the DATABASE_URL environment variable')
-    parser.add_argument('--game', type=str, help='The name of the game', required=True)
+    parser.add_argument('--game', type=str, help='The name of the game (required for all commands that use a game)')
     subparsers = parser.add_subparsers(dest='command', required=True)
 
+    s = subparsers.add_parser('init-db', help='Create or upgrade the database schema')
+    s.set_defaults(function=init_db)
+
     s = subparsers.add_parser('create-game', help='Create a new game')
     s.set_defaults(function=create_game)
     s.add_argument('title', type=str, help='The fancy title of the game')
     s.add_argument('--circle', type=str, action='append', help='Add a circle with the given name', required=True)
     s.add_argument('--password', type=str, help='The game master password', required=True)
     s.add_argument('--endtime', type=datetime.datetime, help='When the game ends')
+    s.add_argument('--code-scheme', type=SecretCodeScheme, choices=list(SecretCodeScheme),
+                   help='How mission codes are derived', default=SecretCodeScheme.v2)
 
     s = subparsers.add_parser('create-test-game', help='Create a populated and running test game')
     s.set_defaults(function=create_test_game)
@@ -115,13 +214,52 @@ def main():
     s = subparsers.add_parser('start-game', help='Start a game and shuffle all its circles')
     s.set_defaults(function=start_game)
 
+    s = subparsers.add_parser('link-missions',
+                              help='Backfill the hunter/target links of all missions in a game that is already running')
+    s.set_defaults(function=link_missions)
+
+    s = subparsers.add_parser('store-mission-codes',
+                              help='Backfill the stored mission codes of a game that is already running')
+    s.set_defaults(function=store_mission_codes)
+
+    s = subparsers.add_parser('rebuild-stats', help='Rebuild the statistics of the game from its missions')
+    s.set_defaults(function=rebuild_stats)
+
     s = subparsers.add_parser('generate-mission-sheets', help='Generate all mission sheet PDFs for the game')
     s.set_defaults(function=generate_mission_sheets)
+    s.add_argument('--workers', type=int, help='The number of mission sheets to render concurrently',
+                   default=config.MISSION_SHEET_WORKERS)
+
+    s = subparsers.add_parser('compile-wordgen-table',
+                              help='Compile and cache the word generator table of the configured corpus')
+    s.set_defaults(function=compile_wordgen_table)
+
+    s = subparsers.add_parser('build-latex-format',
+                              help='Build and cache the precompiled LaTeX format used for mission sheets')
+    s.set_defaults(function=build_latex_format)
+
+    s = subparsers.add_parser('cache-gc', help='Evict the least recently used mission sheets and graphs from the cache')
+    s.set_defaults(function=cache_gc)
+    s.add_argument('--max-size', type=int, help='The maximum size of the cache in bytes',
+                   default=config.CACHE_MAX_SIZE)
+    s.add_argument('--max-age', type=float, help='Remove files that were not used for this many seconds',
+                   default=config.CACHE_MAX_AGE)
+
+    s = subparsers.add_parser('worker', help='Process queued background jobs, e.g. mission updates')
+    s.set_defaults(function=worker)
+    s.add_argument('--concurrency', type=int, help='The number of jobs to process at the same time',
+                   default=config.WORKER_CONCURRENCY)
+    s.add_argument('--once', action='store_true', help='Exit as soon as no job is due instead of waiting for new ones')
 
     s = subparsers.add_parser('generate-graph', help='Generate a mission graph for the game or a subset of its circles')
     s.set_defaults(function=generate_graph)
     s.add_argument('--circle', type=str, action='append', help='Generate the graph for the given circles only',
                    default=[])
+    s.add_argument('--engine', type=str, choices=graph.LAYOUT_ENGINES,
+                   help='The graphviz layout engine, selected by the size of the graph by default')
+    s.add_argument('--compact', action='store_true', help='Leave out the descriptions of the murders')
+    s.add_argument('--timeout', type=float, help='The maximum number of seconds for the layout',
+                   default=config.GRAPH_LAYOUT_TIMEOUT)
 
     s = subparsers.add_parser('record-murder', help='Record a murder')
     s.set_defaults(function=record_murder)
@@ -132,6 +270,12 @@ def main():
     s.add_argument('--when', type=datetime.datetime, help='The time stamp when the murder was committed',
                    default=datetime.datetime.now())
 
+    s = subparsers.add_parser('explain-queries',
+                              help='Print the SQLite query plans of the main mission queries, e.g. to check that '
+                                   'they use the indexes created by init-db. The database must be upgraded with '
+                                   'init-db first.')
+    s.set_defaults(function=explain_queries)
+
     s = subparsers.add_parser('get-missions', help='Print the current missions')
     s.set_defaults(function=get_missions)
     s.add_argument('--player', type=str, help='The name of the player')
@@ -139,9 +283,15 @@ def main():
 
     args = parser.parse_args()
 
-    if 'db' in args:
+    if args.db:
         config.DATABASE_URL = args.db
 
+    if args.function in [init_db, compile_wordgen_table, build_latex_format, cache_gc, worker]:
+        args.function(**vars(args))
+        return
+    elif not args.game:
+        error("The --game argument is required for this command")
+
     with database_transaction() as session:
         if args.function not in [create_game, create_test_game]:
             args.game = Game.by_id(session, str(args.game))
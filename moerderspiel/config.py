@@ -6,10 +6,34 @@ CACHE_DIRECTORY = os.environ['CACHE_DIRECTORY']
 STATE_DIRECTORY = os.environ['STATE_DIRECTORY']
 BASE_URL = os.environ['BASE_URL']
 DATABASE_URL = os.environ.get('DATABASE_URL', default=f"sqlite:///{os.path.join(STATE_DIRECTORY, 'moerderspiel.db')}")
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', default="5"))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', default="10"))
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', default="10000"))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', default=str(256 * 1024 * 1024)))
 SECRET_KEY = os.environ['SECRET_KEY']
+CACHE_MAX_SIZE = int(os.environ.get('CACHE_MAX_SIZE', default=str(1024 * 1024 * 1024)))
+CACHE_MAX_AGE = float(os.environ.get('CACHE_MAX_AGE', default=str(30 * 24 * 60 * 60)))
+CACHE_SWEEP_INTERVAL = float(os.environ.get('CACHE_SWEEP_INTERVAL', default="600"))
+MISSION_SHEET_WORKERS = int(os.environ.get('MISSION_SHEET_WORKERS', default=str(os.cpu_count() or 1)))
+MISSION_SHEET_BATCH_SIZE = int(os.environ.get('MISSION_SHEET_BATCH_SIZE', default="250"))
+MISSION_SHEET_LATEX_FORMAT = os.environ.get('MISSION_SHEET_LATEX_FORMAT', default="1") == "1"
+GRAPH_LAYOUT_TIMEOUT = float(os.environ.get('GRAPH_LAYOUT_TIMEOUT', default="20"))
+GRAPH_LAYOUT_RETRY_INTERVAL = float(os.environ.get('GRAPH_LAYOUT_RETRY_INTERVAL', default="300"))
+NOTIFICATION_COALESCE_SECONDS = float(os.environ.get('NOTIFICATION_COALESCE_SECONDS', default="30"))
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', default="4"))
+WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', default="1"))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', default="5"))
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', default="30"))
+JOB_LEASE = float(os.environ.get('JOB_LEASE', default="600"))
 WORDGEN_CORPUS = os.environ.get('WORDGEN_CORPUS', default='/usr/share/dict/ngerman')
 
 EMAIL_FROM = os.environ.get('EMAIL_FROM', default=None)
 EMAIL_SMTP_HOST = os.environ.get('EMAIL_SMTP_HOST', default="127.0.0.1")
 EMAIL_SMTP_PORT = os.environ.get('EMAIL_SMTP_PORT', default="25")
 EMAIL_HELO_HOSTNAME = os.environ.get('EMAIL_HELO_HOSTNAME', default=socket.getfqdn())
+EMAIL_POOL_SIZE = int(os.environ.get('EMAIL_POOL_SIZE', default="4"))
+EMAIL_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get('EMAIL_MAX_MESSAGES_PER_CONNECTION', default="100"))
+EMAIL_CONCURRENCY = int(os.environ.get('EMAIL_CONCURRENCY', default="4"))
+EMAIL_RATE_LIMIT = float(os.environ.get('EMAIL_RATE_LIMIT', default="0"))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', default="4"))
+EMAIL_RETRY_DELAY = float(os.environ.get('EMAIL_RETRY_DELAY', default="5"))
@@ -1,18 +1,19 @@
+import sqlite3
 from contextlib import contextmanager
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from moerderspiel import constants, wordgen
-from moerderspiel.config import DATABASE_URL
+from moerderspiel import config, constants, wordgen
 
 import enum
-from datetime import datetime
-from typing import List, Optional
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
 
-from sqlalchemy import Engine, Enum, ForeignKey, inspect, select, desc, Select, create_engine, func, event, String
+from sqlalchemy import Engine, Enum, ForeignKey, inspect, select, desc, create_engine, func, event, String, text, and_, \
+    make_url, delete, update, or_, JSON, case
 from sqlalchemy.ext.orderinglist import ordering_list
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session
-from sqlalchemy.schema import CheckConstraint, UniqueConstraint
+from sqlalchemy.schema import CheckConstraint, CreateColumn, Index, UniqueConstraint
 
 
 class Base(DeclarativeBase):
@@ -62,9 +63,25 @@ class Game(Base):
 
     endtime: Mapped[Optional[datetime]]
 
+    """
+    How the secret codes of this game's missions are derived. Games created before this existed use the v1 scheme.
+    """
+    code_scheme: Mapped[Optional[wordgen.SecretCodeScheme]] = mapped_column(Enum(wordgen.SecretCodeScheme))
+
+    """
+    A counter that is increased whenever the state of the game changes in a way that is visible to players, e.g. when
+    the game is started or a mission is completed. Used to key caches of derived data such as graphs.
+    This is None for games that have not changed since the counter was introduced.
+    """
+    revision: Mapped[Optional[int]]
+
     circles: Mapped[List["Circle"]] = relationship(back_populates="game")
     players: Mapped[List["Player"]] = relationship(back_populates="game")
 
+    @property
+    def secret_code_scheme(self) -> wordgen.SecretCodeScheme:
+        return self.code_scheme or wordgen.SecretCodeScheme.v1
+
     @property
     def started(self) -> bool:
         return self.state in [GameState.running, GameState.ended]
@@ -81,6 +98,10 @@ class Game(Base):
     def by_id(cls, session: Session, id: str) -> 'Game':
         return session.scalars(select(cls).where(cls.id == id)).one()
 
+    def bump_revision(self) -> None:
+        # Increment in SQL, so that concurrent transactions cannot both write the same revision
+        self.revision = func.coalesce(Game.revision, 0) + 1
+
     def add(self, something: Base) -> None:
         inspect(self).session.add(something)
 
@@ -100,7 +121,7 @@ class Player(Base):
     """
     The ID of the game to which this player belongs.
     """
-    game_id: Mapped[int] = mapped_column(ForeignKey(Game.id))
+    game_id: Mapped[int] = mapped_column(ForeignKey(Game.id), index=True)
 
     """
     The human-readable, 'fancy' name of the player.
@@ -154,7 +175,7 @@ class Circle(Base):
     """
     The ID of the game to which this circle belongs.
     """
-    game_id: Mapped[int] = mapped_column(ForeignKey(Game.id))
+    game_id: Mapped[int] = mapped_column(ForeignKey(Game.id), index=True)
 
     """
     The unique name of this circle in its game. The name is visible to players.
@@ -199,7 +220,9 @@ class Mission(Base):
     Missions in a Circle are ordered through a position number (modulo the number of missions in the circle). These
     position numbers are assigned randomly when the game is started. In order to find p's current potential victim
     (or killer), we can start at p's mission and "walk forward" (or backward) in the circle until we find the next
-    mission that has not been completed yet.
+    mission that has not been completed yet. Each mission stores the result of these walks in its target_id and
+    hunter_id links, which are updated whenever a mission is completed. Games that were started before these links
+    existed fall back to the circle's CircleRing.
     """
 
     __tablename__ = "mission"
@@ -212,7 +235,7 @@ class Mission(Base):
     """
     The ID of the victim of this mission.
     """
-    victim_id: Mapped[int] = mapped_column(ForeignKey(Player.id), primary_key=True)
+    victim_id: Mapped[int] = mapped_column(ForeignKey(Player.id), primary_key=True, index=True)
 
     """
     The position of this mission in its circle. This is None if and only if the game has not been started yet.
@@ -222,7 +245,7 @@ class Mission(Base):
     """
     The ID of the player who completed this mission.
     """
-    killer_id: Mapped[Optional[int]] = mapped_column(ForeignKey(Player.id))
+    killer_id: Mapped[Optional[int]] = mapped_column(ForeignKey(Player.id), index=True)
 
     """
     The timestamp when this mission was completed.
@@ -234,9 +257,32 @@ class Mission(Base):
     """
     completion_reason: Mapped[Optional[str]] = mapped_column(String(constants.MAX_MURDER_DESCRIPTION_LENGTH))
 
+    """
+    The secret code needed to complete this mission. This is generated when the game is started; use the code
+    property to access it.
+    """
+    _code: Mapped[Optional[str]] = mapped_column('code', String(constants.MISSION_CODE_LENGTH))
+
+    """
+    The ID of the player whose mission follows this one, i.e. the current target of this mission's victim.
+    For a completed mission, this is the target its victim had at the time of completion.
+    This is None if the game has not been started yet, or if the links of the circle have not been backfilled.
+    """
+    target_id: Mapped[Optional[int]] = mapped_column(ForeignKey(Player.id))
+
+    """
+    The ID of the player whose mission precedes this one, i.e. the player currently hunting this mission's victim.
+    For a completed mission, this is the hunter its victim had at the time of completion.
+    This is None if the game has not been started yet, or if the links of the circle have not been backfilled.
+    """
+    hunter_id: Mapped[Optional[int]] = mapped_column(ForeignKey(Player.id))
+
     __table_args__ = (
         UniqueConstraint(circle_id, position),
 
+        # Most queries look for the uncompleted (or completed) missions of a circle, often ordered by position
+        Index('ix_mission_circle_id_completion_date_position', 'circle_id', 'completion_date', 'position'),
+
         # A completed mission must have both a completion date and reason. The killer is optional here;
         # killer_id == NULL on a completed mission indicates a kick or other administrative action.
         CheckConstraint("(completion_date == NULL and completion_reason == NULL)"
@@ -247,43 +293,73 @@ class Mission(Base):
     victim: Mapped[Player] = relationship(back_populates="victim_missions", foreign_keys=victim_id)
     killer: Mapped[Optional[Player]] = relationship(back_populates="completed_missions", foreign_keys=killer_id)
 
-    def _previous(self, query: Select) -> 'Mission':
-        """
-        Get the previous mission in the same circle based on the given query.
-        """
-        basequery = query.where(Mission.circle == self.circle).order_by(desc(Mission.position)).limit(1)
-
-        return self._query(basequery.where(Mission.position < self.position)).one_or_none() \
-            or self._query(basequery.where(Mission.position > self.position)).one_or_none()
-
-    def _next(self, query: Select) -> 'Mission':
+    def _ring(self) -> Optional['CircleRing']:
         """
-        Get the next mission in the same circle based on the given query.
+        Get the ring index of this mission's circle, or None if the circle has not been shuffled yet.
         """
-        basequery = query.where(Mission.circle == self.circle).order_by(Mission.position).limit(1)
-
-        return self._query(basequery.where(Mission.position > self.position)).one_or_none() \
-            or self._query(basequery.where(Mission.position < self.position)).one_or_none()
+        if self.position is None:
+            return None
+        return CircleRing.for_circle(self.circle)
 
     @property
     def previous(self) -> 'Mission':
         """
         The previous mission in the circle.
         """
-        return self._previous(select(Mission))
+        ring = self._ring()
+        return ring.previous(self) if ring else None
 
     @property
     def next(self) -> 'Mission':
         """
         The next mission in the circle.
         """
-        return self._next(select(Mission))
+        ring = self._ring()
+        return ring.next(self) if ring else None
 
-    def get_next_uncompleted(self) -> 'Mission':
-        return self._next(select(Mission).where(Mission.completion_date == None))
+    def _linked(self, player_id: int) -> 'Mission':
+        """
+        Get the mission of the given player in the same circle. This is a primary key lookup, which is usually
+        answered from the session's identity map.
+        """
+        return inspect(self).session.get(Mission, (self.circle_id, player_id))
 
-    def get_previous_uncompleted(self) -> 'Mission':
-        return self._previous(select(Mission).where(Mission.completion_date == None))
+    def _follow(self, attribute: str) -> Optional['Mission']:
+        """
+        Follow the target_id or hunter_id links until an uncompleted mission is reached. Uncompleted missions always
+        link to uncompleted missions, so this only takes more than one step when starting at a completed mission.
+        Returns None if the links run in a cycle of completed missions, i.e. if every mission of the circle has been
+        completed (which backdated murders can cause).
+        """
+        visited = {self.victim_id}
+        mission = self._linked(getattr(self, attribute))
+        while mission.completed:
+            if mission.victim_id in visited:
+                return None
+            visited.add(mission.victim_id)
+            mission = mission._linked(getattr(mission, attribute))
+        return mission
+
+    def get_next_uncompleted(self) -> Optional['Mission']:
+        if self.target_id is not None:
+            return self._follow('target_id')
+
+        ring = self._ring()
+        return ring.next_uncompleted(self) if ring else None
+
+    def get_previous_uncompleted(self) -> Optional['Mission']:
+        if self.hunter_id is not None:
+            return self._follow('hunter_id')
+
+        ring = self._ring()
+        return ring.previous_uncompleted(self) if ring else None
+
+    def link(self, hunter: 'Mission', target: 'Mission') -> None:
+        """
+        Set the persisted links of this mission to the given neighbouring missions.
+        """
+        self.hunter_id = hunter.victim_id
+        self.target_id = target.victim_id
 
     @property
     def initial_owner(self) -> Player:
@@ -299,13 +375,43 @@ class Mission(Base):
         """
         return self.get_previous_uncompleted().victim
 
+    @property
+    def code_salt(self) -> str:
+        """
+        The salt from which the secret code of this mission is derived.
+        """
+        return f"{self.victim.game.id}/{self.victim_id}/{self.circle_id}"
+
     @property
     def code(self) -> str:
         """
-        The secret code needed to complete this mission.
+        The secret code needed to complete this mission. Codes are stored when the game is started (see
+        generate_codes). Missions of games that were started before codes were stored derive their code on every
+        access until the store-mission-codes command has been run.
+        """
+        if self._code is None:
+            return wordgen.generate_secret_code(salt=self.code_salt, length=constants.MISSION_CODE_LENGTH,
+                                                scheme=self.game.secret_code_scheme)
+        return self._code
+
+    def check_code(self, code: str) -> bool:
+        """
+        Check whether the given code matches the secret code of this mission.
+        """
+        return wordgen.check_secret_code(self.code, code)
+
+    @classmethod
+    def generate_codes(cls, missions: List['Mission']) -> None:
+        """
+        Generate and store the secret codes of all given missions at once. All missions must belong to the same game.
         """
-        return wordgen.generate_secret_code(salt=f"{self.victim.game.id}/{self.victim_id}/{self.circle_id}",
-                                            length=constants.MISSION_CODE_LENGTH)
+        if not missions:
+            return
+
+        codes = wordgen.generate_secret_codes([m.code_salt for m in missions], length=constants.MISSION_CODE_LENGTH,
+                                              scheme=missions[0].game.secret_code_scheme)
+        for mission, code in zip(missions, codes):
+            mission._code = code
 
     @property
     def completed(self) -> bool:
@@ -319,6 +425,18 @@ class Mission(Base):
         return self.circle.game
 
     def complete(self, killer: Player | None, when: datetime, reason: str) -> None:
+        # Splice this mission out of the links of the circle. The mission itself keeps its links, so that walking
+        # from it still leads to the right uncompleted missions (see _follow).
+        hunter = self.get_previous_uncompleted()
+        target = self.get_next_uncompleted()
+        if self.hunter_id is not None and hunter and target:
+            hunter.target_id = target.victim_id
+            target.hunter_id = hunter.victim_id
+
+        ring = CircleRing.for_circle(self.circle, build=False)
+        if ring:
+            ring.remove(self)
+
         self.killer = killer
         self.completion_date = when
         self.completion_reason = reason
@@ -354,6 +472,31 @@ class Mission(Base):
     def achievable_missions_in_game(cls, game: Game) -> List['Mission']:
         return sum([cls.achievable_missions_in_circle(c) for c in game.circles], [])
 
+    @classmethod
+    def current_assignments_in_game(cls, game: Game) -> List['Assignment']:
+        """
+        Get the current owner of every achievable mission in the game, ordered by owner name and circle.
+        This runs a single query, in which the owner of each uncompleted mission is the victim of the preceding
+        uncompleted mission in the same circle (wrapping around to the last one).
+        """
+        circle_order = dict(partition_by=cls.circle_id, order_by=cls.position)
+        uncompleted = select(
+            cls.circle_id,
+            cls.victim_id,
+            func.coalesce(func.lag(cls.victim_id).over(**circle_order),
+                          func.last_value(cls.victim_id).over(**circle_order, range_=(None, None))).label('owner_id'),
+            func.count().over(partition_by=cls.circle_id).label('uncompleted_count'),
+        ).join(Circle).where(Circle.game_id == game.id).where(cls.completion_date == None).subquery()
+
+        query = select(Player, cls) \
+            .join(uncompleted, and_(cls.circle_id == uncompleted.c.circle_id,
+                                    cls.victim_id == uncompleted.c.victim_id)) \
+            .join(Player, Player.id == uncompleted.c.owner_id) \
+            .where(uncompleted.c.uncompleted_count > 1) \
+            .order_by(Player.name, cls.circle_id)
+
+        return [Assignment(owner, mission) for owner, mission in inspect(game).session.execute(query)]
+
     @classmethod
     def achievable_missions_by_victim(cls, victim: Player) -> List['Mission']:
         return list(v for v in victim.victim_missions if (not v.completed) and (v.get_next_uncompleted() != v))
@@ -368,22 +511,163 @@ class Mission(Base):
 
     @classmethod
     def completed_missions_in_game(cls, game: Game) -> List['Mission']:
-        return list(game._query(select(cls).where(cls.circle.has(Circle.game == game)).where(cls.completion_date != None)).all())
+        return list(game._query(select(cls).join(Circle).where(Circle.game_id == game.id)
+                                .where(cls.completion_date != None)).all())
 
     @classmethod
     def by_killer(cls, killer: Player) -> List['Mission']:
         return list(killer._query(select(cls).where(cls.killer == killer)).all())
 
+    @classmethod
+    def leaderboard_by_game(cls, game: Game, limit: int = None) -> List['KillCount']:
+        """
+        Get the players of the game who completed at least one mission, with their number of completed missions,
+        ordered by that number. If a limit is given, only the players on the first `limit` ranks are returned, so there
+        may be more players than that if they are tied.
+        """
+        kill_counts = select(
+            cls.killer_id,
+            func.count().label('kills'),
+            func.rank().over(order_by=desc(func.count())).label('rank'),
+        ).join(Player, Player.id == cls.killer_id).where(Player.game_id == game.id).group_by(cls.killer_id).subquery()
+
+        query = select(Player, kill_counts.c.kills) \
+            .join(kill_counts, Player.id == kill_counts.c.killer_id) \
+            .order_by(desc(kill_counts.c.kills), Player.name)
+        if limit:
+            query = query.where(kill_counts.c.rank <= limit)
+
+        return [KillCount(player, kills) for player, kills in inspect(game).session.execute(query)]
+
     @classmethod
     def mass_murderers_by_game(cls, game: Game) -> List[Player]:
-        max_kill_count = game._query(
-            select(func.count()).select_from(Mission).where(Mission.killer_id != None).group_by(
-                Mission.killer_id).order_by(desc(func.count())).limit(1)).one_or_none()
+        return [entry.player for entry in cls.leaderboard_by_game(game, limit=1)]
 
-        if not max_kill_count:
-            return []
-        else:
-            return list(p for p in game.players if len(cls.by_killer(p)) == max_kill_count)
+
+class Assignment(NamedTuple):
+    """
+    A mission together with the player who currently owns it.
+    """
+
+    owner: Player
+    mission: Mission
+
+    @property
+    def target(self) -> Player:
+        return self.mission.victim
+
+    @property
+    def circle(self) -> Circle:
+        return self.mission.circle
+
+
+class KillCount(NamedTuple):
+    """
+    A player together with the number of missions they completed.
+    """
+
+    player: Player
+    kills: int
+
+
+class CircleRing:
+    """
+    An in-memory index over the missions of a circle, ordered by their position.
+
+    Besides the full order of the circle, the ring keeps a doubly linked list of all uncompleted missions. Removing a
+    mission from that list leaves the mission's own links untouched, so that a completed mission still points to the
+    neighbours it had when it was completed. Walking forward (or backward) from any mission therefore only ever
+    passes completed missions that were removed after it, and successor/predecessor lookups of uncompleted missions
+    are O(1).
+
+    A ring is built once per circle and session transaction (see for_circle) and kept up to date by Mission.complete.
+    """
+
+    SESSION_INFO_KEY = 'circle_rings'
+
+    def __init__(self, missions: List[Mission]):
+        self.missions = sorted(missions, key=lambda m: m.position)
+        self.index = {m.victim_id: i for i, m in enumerate(self.missions)}
+        self.alive = [not m.completed for m in self.missions]
+        self.alive_count = sum(self.alive)
+        self.next_alive = [0] * len(self.missions)
+        self.previous_alive = [0] * len(self.missions)
+
+        alive_indices = [i for i, alive in enumerate(self.alive) if alive]
+        if not alive_indices:
+            return
+
+        # Link every mission (completed or not) to the nearest uncompleted missions before and after it
+        following = alive_indices[0]
+        for i in reversed(range(len(self.missions))):
+            self.next_alive[i] = following
+            if self.alive[i]:
+                following = i
+
+        preceding = alive_indices[-1]
+        for i in range(len(self.missions)):
+            self.previous_alive[i] = preceding
+            if self.alive[i]:
+                preceding = i
+
+    @classmethod
+    def for_circle(cls, circle: Circle, build: bool = True) -> Optional['CircleRing']:
+        """
+        Get the ring of the given circle from its session, building it first if necessary (and if build is True).
+        """
+        rings = inspect(circle).session.info.setdefault(cls.SESSION_INFO_KEY, {})
+        if circle.id not in rings and build:
+            rings[circle.id] = cls(circle._query(select(Mission).where(Mission.circle == circle)).all())
+        return rings.get(circle.id)
+
+    @classmethod
+    def discard(cls, circle: Circle) -> None:
+        """
+        Forget the ring of the given circle, e.g. because the positions of its missions have changed.
+        """
+        inspect(circle).session.info.get(cls.SESSION_INFO_KEY, {}).pop(circle.id, None)
+
+    def _walk(self, i: int, links: List[int]) -> Optional[int]:
+        # Backdated murders can complete every mission of a circle, then there is nothing to walk to
+        if not self.alive_count:
+            return None
+        while not self.alive[i]:
+            i = links[i]
+        return i
+
+    def next(self, mission: Mission) -> Mission:
+        return self.missions[(self.index[mission.victim_id] + 1) % len(self.missions)]
+
+    def previous(self, mission: Mission) -> Mission:
+        return self.missions[(self.index[mission.victim_id] - 1) % len(self.missions)]
+
+    def next_uncompleted(self, mission: Mission) -> Optional[Mission]:
+        i = self._walk(self.next_alive[self.index[mission.victim_id]], self.next_alive)
+        return self.missions[i] if i is not None else None
+
+    def previous_uncompleted(self, mission: Mission) -> Optional[Mission]:
+        i = self._walk(self.previous_alive[self.index[mission.victim_id]], self.previous_alive)
+        return self.missions[i] if i is not None else None
+
+    def remove(self, mission: Mission) -> None:
+        """
+        Unlink the given mission from the list of uncompleted missions.
+        """
+        i = self.index[mission.victim_id]
+        if not self.alive[i]:
+            return
+
+        self.alive[i] = False
+        self.alive_count -= 1
+        self.next_alive[self.previous_alive[i]] = self.next_alive[i]
+        self.previous_alive[self.next_alive[i]] = self.previous_alive[i]
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def discard_circle_rings(session: Session, transaction):
+    # Other sessions may have completed missions in the meantime, so rings only live as long as one transaction
+    if transaction.parent is None:
+        session.info.pop(CircleRing.SESSION_INFO_KEY, None)
 
 
 class NotificationAddressType(enum.StrEnum):
@@ -401,15 +685,419 @@ class NotificationAddress(Base):
     player: Mapped[Player] = relationship(back_populates="notification_addresses")
 
 
+class PlayerStatistics(Base):
+    """
+    Materialized statistics of a player in a running game. See GameStatistics.
+    """
+
+    __tablename__ = "player_statistics"
+
+    player_id: Mapped[int] = mapped_column(ForeignKey(Player.id), primary_key=True)
+    game_id: Mapped[str] = mapped_column(ForeignKey(Game.id), index=True)
+
+    """
+    The number of missions this player has completed.
+    """
+    kills: Mapped[int] = mapped_column(default=0)
+
+    """
+    The number of circles in which this player is still alive.
+    """
+    alive_circles: Mapped[int] = mapped_column(default=0)
+
+    @property
+    def alive(self) -> bool:
+        return self.alive_circles > 0
+
+
+class CircleStatistics(Base):
+    """
+    Materialized statistics of a circle in a running game. See GameStatistics.
+    """
+
+    __tablename__ = "circle_statistics"
+
+    circle_id: Mapped[int] = mapped_column(ForeignKey(Circle.id), primary_key=True)
+    game_id: Mapped[str] = mapped_column(ForeignKey(Game.id), index=True)
+
+    """
+    The number of uncompleted missions, i.e. of players who are still alive in this circle.
+    """
+    alive: Mapped[int] = mapped_column(default=0)
+
+    """
+    The number of completed missions in this circle.
+    """
+    murders: Mapped[int] = mapped_column(default=0)
+
+
+class GameStatistics(Base):
+    """
+    Materialized statistics of a running game, so that pages do not have to walk all missions of the game to show
+    a few numbers.
+
+    The statistics are created when the game is started and are updated by GameService whenever a mission is
+    completed, in the same transaction. They can be rebuilt from the missions at any time.
+    """
+
+    __tablename__ = "game_statistics"
+
+    game_id: Mapped[str] = mapped_column(ForeignKey(Game.id), primary_key=True)
+
+    """
+    The number of players in the game.
+    """
+    players: Mapped[int] = mapped_column(default=0)
+
+    """
+    The number of players who are still alive in at least one circle.
+    """
+    alive_players: Mapped[int] = mapped_column(default=0)
+
+    """
+    The number of completed missions in the game.
+    """
+    murders: Mapped[int] = mapped_column(default=0)
+
+    @classmethod
+    def for_game(cls, game: Game) -> 'GameStatistics':
+        """
+        Get the statistics of the game. If they have not been built yet, e.g. for a game that was started before
+        statistics existed, they are computed from the missions without being stored; init_database() builds them.
+        """
+        return inspect(game).session.get(cls, game.id) or cls.compute(game)[0]
+
+    @classmethod
+    def players_by_game(cls, game: Game) -> Dict[int, PlayerStatistics]:
+        if not inspect(game).session.get(cls, game.id):
+            return {s.player_id: s for s in cls.compute(game)[1]}
+        return {s.player_id: s for s in game._query(select(PlayerStatistics).where(PlayerStatistics.game_id == game.id))}
+
+    @classmethod
+    def circles_by_game(cls, game: Game) -> Dict[int, CircleStatistics]:
+        if not inspect(game).session.get(cls, game.id):
+            return {s.circle_id: s for s in cls.compute(game)[2]}
+        return {s.circle_id: s for s in game._query(select(CircleStatistics).where(CircleStatistics.game_id == game.id))}
+
+    @classmethod
+    def compute(cls, game: Game) -> Tuple['GameStatistics', List[PlayerStatistics], List[CircleStatistics]]:
+        """
+        Compute the statistics of the game and of its players and circles from its missions, without storing them.
+        """
+        session = inspect(game).session
+        kills = dict(session.execute(
+            select(Mission.killer_id, func.count()).join(Player, Player.id == Mission.killer_id)
+            .where(Player.game_id == game.id).group_by(Mission.killer_id)).all())
+        alive_circles = dict(session.execute(
+            select(Mission.victim_id, func.count()).join(Player, Player.id == Mission.victim_id)
+            .where(Player.game_id == game.id).where(Mission.completion_date == None)
+            .group_by(Mission.victim_id)).all())
+        circle_counts = session.execute(
+            select(Mission.circle_id, func.count(), func.count(Mission.completion_date)).join(Circle)
+            .where(Circle.game_id == game.id).group_by(Mission.circle_id)).all()
+        player_ids = session.scalars(select(Player.id).where(Player.game_id == game.id)).all()
+
+        players = [PlayerStatistics(player_id=player_id, game_id=game.id, kills=kills.get(player_id, 0),
+                                    alive_circles=alive_circles.get(player_id, 0))
+                   for player_id in player_ids]
+        circles = [CircleStatistics(circle_id=circle_id, game_id=game.id, alive=total - murders, murders=murders)
+                   for circle_id, total, murders in circle_counts]
+        statistics = GameStatistics(game_id=game.id, players=len(player_ids), alive_players=len(alive_circles),
+                                    murders=sum(murders for _, _, murders in circle_counts))
+        return statistics, players, circles
+
+    @classmethod
+    def rebuild(cls, game: Game) -> 'GameStatistics':
+        """
+        Build the statistics of the game from its missions, replacing any existing statistics.
+        """
+        session = inspect(game).session
+        for table in [PlayerStatistics, CircleStatistics, GameStatistics]:
+            session.execute(delete(table).where(table.game_id == game.id))
+
+        statistics, players, circles = cls.compute(game)
+        session.add_all([*players, *circles, statistics])
+        return statistics
+
+    @classmethod
+    def build_missing(cls, session: Session) -> int:
+        """
+        Build the statistics of all started games that do not have statistics yet, and return the number of games.
+        """
+        games = session.scalars(select(Game).where(Game.state != GameState.new)
+                                .where(~select(cls.game_id).where(cls.game_id == Game.id).exists())).all()
+        for game in games:
+            cls.rebuild(game)
+        return len(games)
+
+    @classmethod
+    def record_completion(cls, mission: Mission) -> None:
+        """
+        Update the statistics of the mission's game after the mission has been completed.
+        """
+        session = inspect(mission).session
+        statistics = session.get(cls, mission.game.id)
+        if not statistics:
+            cls.rebuild(mission.game)
+            return
+
+        # Increment in SQL, so that concurrent completions in the same game cannot overwrite each other's counts
+        session.execute(update(CircleStatistics).where(CircleStatistics.circle_id == mission.circle_id)
+                        .values(alive=CircleStatistics.alive - 1, murders=CircleStatistics.murders + 1))
+        session.execute(update(PlayerStatistics).where(PlayerStatistics.player_id == mission.victim_id)
+                        .values(alive_circles=PlayerStatistics.alive_circles - 1))
+        if mission.killer:
+            session.execute(update(PlayerStatistics).where(PlayerStatistics.player_id == mission.killer.id)
+                            .values(kills=PlayerStatistics.kills + 1))
+
+        victim_dead = select(PlayerStatistics.player_id).where(PlayerStatistics.player_id == mission.victim_id) \
+            .where(PlayerStatistics.alive_circles == 0).exists()
+        session.execute(update(cls).where(cls.game_id == mission.game.id)
+                        .values(murders=cls.murders + 1,
+                                alive_players=cls.alive_players - case((victim_dead, 1), else_=0)))
+
+
+class JobKind(enum.StrEnum):
+    mission_update = enum.auto()
+    game_mission_updates = enum.auto()
+
+
+class JobState(enum.StrEnum):
+    pending = enum.auto()
+    running = enum.auto()
+    done = enum.auto()
+    failed = enum.auto()
+
+
+class Job(Base):
+    """
+    A background job, e.g. sending a mission update to a player, which is processed by the worker (see jobs.py).
+
+    Jobs are enqueued in the same transaction as the change that caused them, so they are only run if that change is
+    committed. A job is claimed by setting it to running with a lease, which the worker renews while the job is
+    running; if the worker dies, the job can be claimed again after the lease has expired. Failed attempts are retried
+    with an exponential backoff. Jobs that consist of many parts record the parts they have done (see JobProgress), so
+    that a retry does not do them again.
+    """
+
+    __tablename__ = "job"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+    """
+    The game this job belongs to.
+    """
+    game_id: Mapped[str] = mapped_column(ForeignKey(Game.id), index=True)
+
+    """
+    What the job does. This selects the handler that runs it.
+    """
+    kind: Mapped[JobKind] = mapped_column(Enum(JobKind))
+
+    """
+    The arguments of the handler.
+    """
+    payload: Mapped[Dict[str, Any]] = mapped_column(JSON)
+
+    """
+    Pending jobs with the same deduplication key are merged into one when they are enqueued.
+    """
+    dedup_key: Mapped[Optional[str]] = mapped_column(index=True)
+
+    state: Mapped[JobState] = mapped_column(Enum(JobState), default=JobState.pending)
+
+    """
+    The number of times the job has been claimed.
+    """
+    attempts: Mapped[int] = mapped_column(default=0)
+
+    """
+    The job is not run before this time.
+    """
+    run_after: Mapped[datetime]
+
+    """
+    While the job is running, the time after which it can be claimed by another worker.
+    """
+    locked_until: Mapped[Optional[datetime]]
+
+    """
+    The error of the last failed attempt.
+    """
+    last_error: Mapped[Optional[str]]
+
+    __table_args__ = (
+        Index('ix_job_state_run_after', 'state', 'run_after'),
+    )
+
+    @classmethod
+    def enqueue(cls, game: Game, kind: JobKind, payload: Dict[str, Any], dedup_key: str = None,
+                run_after: datetime = None) -> 'Job':
+        """
+        Add a job for the game to the queue, unless a pending job with the same deduplication key already exists.
+        In that case, the existing job is run at the earlier of both times.
+        """
+        run_after = run_after or datetime.now()
+        if dedup_key:
+            job = game._query(select(cls).where(cls.dedup_key == dedup_key).where(cls.state == JobState.pending)).first()
+            if job:
+                job.run_after = min(job.run_after, run_after)
+                return job
+
+        job = Job(game_id=game.id, kind=kind, payload=payload, dedup_key=dedup_key, state=JobState.pending, attempts=0,
+                  run_after=run_after)
+        game.add(job)
+        return job
+
+    @classmethod
+    def claim(cls, session: Session, limit: int, lease: timedelta) -> List[int]:
+        """
+        Claim up to limit jobs that are due, and return their IDs. Each job is claimed with a conditional update, so
+        concurrent workers never claim the same job.
+        """
+        now = datetime.now()
+        candidates = session.scalars(
+            select(cls.id)
+            .where(or_(and_(cls.state == JobState.pending, cls.run_after <= now),
+                       and_(cls.state == JobState.running, cls.locked_until < now)))
+            .order_by(cls.run_after, cls.id).limit(limit)).all()
+
+        claimed = []
+        for job_id in candidates:
+            result = session.execute(
+                update(cls).where(cls.id == job_id)
+                .where(or_(cls.state == JobState.pending, and_(cls.state == JobState.running, cls.locked_until < now)))
+                .values(state=JobState.running, attempts=cls.attempts + 1, locked_until=now + lease))
+            if result.rowcount:
+                claimed.append(job_id)
+        return claimed
+
+    @classmethod
+    def renew(cls, session: Session, job_ids: List[int], lease: timedelta) -> None:
+        """
+        Extend the lease of the given jobs that are still running, so that no other worker claims them while their
+        worker is alive.
+        """
+        session.execute(update(cls).where(cls.id.in_(job_ids)).where(cls.state == JobState.running)
+                        .values(locked_until=datetime.now() + lease))
+
+    @property
+    def progress(self) -> Set[str]:
+        """
+        The keys of the parts of this job that have been done by earlier attempts.
+        """
+        return set(inspect(self).session.scalars(select(JobProgress.key).where(JobProgress.job_id == self.id)))
+
+    @classmethod
+    def record_progress(cls, session: Session, job_id: int, key: str) -> None:
+        session.merge(JobProgress(job_id=job_id, key=key))
+
+    def finish(self) -> None:
+        self.state = JobState.done
+        self.locked_until = None
+        self.last_error = None
+
+    def fail(self, error: str, max_attempts: int, retry_delay: float) -> None:
+        """
+        Record a failed attempt, and schedule a retry with an exponential backoff unless the job has been attempted
+        max_attempts times already.
+        """
+        self.last_error = error
+        self.locked_until = None
+        if self.attempts >= max_attempts:
+            self.state = JobState.failed
+        else:
+            self.state = JobState.pending
+            self.run_after = datetime.now() + timedelta(seconds=retry_delay * 2 ** (self.attempts - 1))
+
+
+class JobProgress(Base):
+    """
+    A part of a job that has been done, e.g. a message that has been delivered. It is recorded in its own transaction
+    as soon as the part is done, so it survives a failed attempt and even a crash of the worker.
+    """
+
+    __tablename__ = "job_progress"
+
+    job_id: Mapped[int] = mapped_column(ForeignKey(Job.id), primary_key=True)
+    key: Mapped[str] = mapped_column(primary_key=True)
+
+
 @event.listens_for(Game.gamemaster_password, 'set', named=True, retval=True)
 def hash_user_password(value: str, oldvalue: str, **kwargs):
     return value if value == oldvalue else generate_password_hash(value)
 
 
+def upgrade_schema(engine: Engine) -> None:
+    """
+    Upgrade the tables of an existing database in place to match the models. create_all() only creates missing
+    tables (with their indexes), so this adds the columns and indexes that have been added to the models after the
+    database was created.
+    Only nullable columns without defaults can be added this way.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_definition = CreateColumn(column).compile(dialect=engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_definition}"))
+
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def engine_options(url: str) -> Dict:
+    """
+    Get the options for creating an engine for the given database URL.
+    SQLite engines keep SQLAlchemy's default pool, every other database gets a pool of the configured size.
+    """
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {}
+    else:
+        return dict(pool_size=config.DATABASE_POOL_SIZE, max_overflow=config.DATABASE_MAX_OVERFLOW, pool_pre_ping=True)
+
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    # WAL lets readers continue while a murder is being written, and NORMAL synchronization is safe in WAL mode.
+    # Concurrent writers wait for each other instead of failing with "database is locked".
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(config.SQLITE_BUSY_TIMEOUT)}")
+    cursor.execute(f"PRAGMA mmap_size={int(config.SQLITE_MMAP_SIZE)}")
+    cursor.close()
+
+
+_engines: Dict[str, Engine] = {}
+
+
 def connect_to_database() -> Engine:
-    engine = create_engine(DATABASE_URL)
+    """
+    Get the engine for the configured database. There is only one engine (and therefore one connection pool) per
+    database and process.
+    """
+    if config.DATABASE_URL not in _engines:
+        _engines[config.DATABASE_URL] = create_engine(config.DATABASE_URL, **engine_options(config.DATABASE_URL))
+    return _engines[config.DATABASE_URL]
+
+
+def init_database() -> None:
+    """
+    Create all missing tables, columns and indexes in the configured database, and build the statistics of games
+    that were started before statistics existed.
+    """
+    engine = connect_to_database()
     Base.metadata.create_all(engine)
-    return engine
+    upgrade_schema(engine)
+
+    with database_transaction() as session:
+        GameStatistics.build_missing(session)
 
 
 @contextmanager
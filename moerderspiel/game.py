@@ -1,11 +1,14 @@
+import functools
 import random
 
-from moerderspiel import notification, pdf
-from moerderspiel.db import GameState, Game, Circle, Player, Mission, NotificationAddressType, NotificationAddress
+from moerderspiel import config, notification, pdf
+from moerderspiel.wordgen import SecretCodeScheme
+from moerderspiel.db import GameState, Game, Circle, Player, Mission, NotificationAddressType, NotificationAddress, \
+    CircleRing, GameStatistics, Job, JobKind
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Callable, Collection, List
 
 
 class GameError(RuntimeError):
@@ -16,6 +19,10 @@ class GameError(RuntimeError):
         return self.value
 
 
+def build_mission_update(address: str, mission_sheet_paths: List[str], game_title: str):
+    return notification.email.build_mission_update(address, pdf.merge_mission_sheets(mission_sheet_paths), game_title)
+
+
 class GameService:
     def __init__(self, game: Game):
         self.game = game
@@ -50,6 +57,7 @@ class GameService:
 
         player = Player(game=self.game, name=name, **kwargs)
         self.game.add(player)
+        self.game.bump_revision()
         return player
 
     def add_notification_address(self, player: str | Player, type: NotificationAddressType, address: str):
@@ -61,7 +69,7 @@ class GameService:
         ))
 
         if self.game.state == GameState.running:
-            self.send_mission_update(player)
+            self.send_mission_update(player, coalesce=False)
 
     def add_circle(self, name: str, players: List[Player | str] = None, **kwargs) -> Circle:
         if self.game.state != GameState.new:
@@ -71,6 +79,7 @@ class GameService:
 
         circle = Circle(game=self.game, name=name, **kwargs)
         self.game.add(circle)
+        self.game.bump_revision()
 
         if players:
             for player in players:
@@ -83,6 +92,7 @@ class GameService:
             raise GameError("Game has already been started")
 
         self.get_circle(circle).delete()
+        self.game.bump_revision()
 
     def delete_player(self, player: Player | str):
         if self.game.started:
@@ -90,6 +100,7 @@ class GameService:
 
         # TODO: Handle pending address verification requests
         self.get_player(player).delete()
+        self.game.bump_revision()
 
     def add_player_to_circle(self, player: str | Player, circle: str | Circle):
         player = self.get_player(player)
@@ -99,12 +110,16 @@ class GameService:
             raise GameError(f"Player '{player.name}' is already part of circle '{circle.name}'")
 
         self.game.add(Mission(circle=circle, victim=player))
+        self.game.bump_revision()
 
     def shuffle_circle(self, circle: str | Circle) -> None:
         if self.game.state != GameState.new:
             raise GameError("Game has already been started")
 
-        missions = list(self.get_circle(circle).missions)
+        circle = self.get_circle(circle)
+        CircleRing.discard(circle)
+
+        missions = list(circle.missions)
         random.shuffle(missions)
 
         previous_mission = None
@@ -115,15 +130,42 @@ class GameService:
             # of missions-to-place, try to find the first one that belongs to a different group than the previous
             # mission we placed.
             for i in range(len(missions)):
-                mission = missions[i]
                 if not previous_mission or not previous_mission.victim.group \
-                        or mission.victim.group != previous_mission.victim.group:
-                    del missions[i]
+                        or missions[i].victim.group != previous_mission.victim.group:
+                    mission = missions.pop(i)
                     break
+            else:
+                # Only players from the same group are left, so we cannot avoid placing them next to each other
+                mission = missions.pop(0)
 
             mission.position = position
             previous_mission = mission
 
+        self.link_circle(circle)
+
+    def link_circle(self, circle: str | Circle) -> None:
+        """
+        Set the persisted hunter/target links of all missions in the circle from their positions.
+        This is done when the circle is shuffled, and can be used to backfill games that were started before the links
+        existed.
+        """
+        circle = self.get_circle(circle)
+        CircleRing.discard(circle)
+        ring = CircleRing.for_circle(circle)
+
+        for mission in ring.missions:
+            hunter = ring.previous_uncompleted(mission)
+            target = ring.next_uncompleted(mission)
+            # If every mission of the circle is completed, there is nothing to link to, so the links are kept
+            if hunter and target:
+                mission.link(hunter=hunter, target=target)
+
+    def generate_mission_codes(self, missing_only: bool = False) -> None:
+        missions = [m for c in self.game.circles for m in c.missions]
+        if missing_only:
+            missions = [m for m in missions if m._code is None]
+        Mission.generate_codes(missions)
+
     def start_game(self):
         if self.game.state != GameState.new:
             raise GameError("Game has already been started")
@@ -132,13 +174,19 @@ class GameService:
         elif not self.game.players:
             raise GameError("Game does not have any players")
 
+        # Make sure that all missions know the IDs of their victims before linking them
+        self.flush_changes()
+
         for circle in self.game.circles:
             self.shuffle_circle(circle)
 
+        self.generate_mission_codes()
         self.game.state = GameState.running
+        GameStatistics.rebuild(self.game)
+        self.game.bump_revision()
 
-        for player in self.game.players:
-            self.send_mission_update(player)
+        if any(player.notifiable for player in self.game.players):
+            Job.enqueue(self.game, JobKind.game_mission_updates, dict(game_id=self.game.id))
 
     def record_murder(self, killer: str | Player, victim: str | Player, circle: str | Circle, when: datetime,
                       reason: str, code: str) -> None:
@@ -156,7 +204,7 @@ class GameService:
             raise GameError("Victim is not part of this circle")
         elif mission.completed:
             raise GameError("Victim is already dead in this circle")
-        elif code and code != mission.code:
+        elif code and not mission.check_code(code):
             raise GameError("Validation code does not match")
 
         killer_mission = Mission.by_victim_in_circle(killer, circle)
@@ -166,16 +214,21 @@ class GameService:
             raise GameError("Killer was already dead at that time")
 
         owner = mission.current_owner
-        mission.complete(killer, when, reason)
+        self.complete_mission(mission, killer, when, reason)
         self.send_mission_update(owner)
         self.send_mission_update(victim)
 
+    def complete_mission(self, mission: Mission, killer: Player | None, when: datetime, reason: str) -> None:
+        mission.complete(killer, when, reason)
+        GameStatistics.record_completion(mission)
+        self.game.bump_revision()
+
     def kick_player(self, player: str | Player, when: datetime, reason: str):
         players_to_notify = set()
 
         for mission in Mission.achievable_missions_by_victim(self.get_player(player)):
             players_to_notify.add(mission.current_owner)
-            mission.complete(None, when, reason)
+            self.complete_mission(mission, None, when, reason)
 
         for p in players_to_notify:
             self.send_mission_update(p)
@@ -184,20 +237,83 @@ class GameService:
         owner = self.get_player(owner)
         return sorted(Mission.achievable_missions_by_current_owner(owner), key=lambda m: m.circle_id)
 
-    def send_mission_update(self, player: str | Player):
+    def send_mission_update(self, player: str | Player, coalesce: bool = True):
+        """
+        Queue a mission update for the player. The worker sends it once the current transaction has been committed;
+        further updates for the player that are queued before then are merged into this one.
+
+        If coalesce is set, the update is held back for NOTIFICATION_COALESCE_SECONDS, so that a burst of murders
+        results in a single update with the final missions of the player. Otherwise it is sent right away.
+        """
+        player = self.get_player(player)
+        if player.notifiable:
+            self.flush_changes()
+            delay = config.NOTIFICATION_COALESCE_SECONDS if coalesce else 0
+            Job.enqueue(self.game, JobKind.mission_update, dict(player_id=player.id),
+                        dedup_key=f"mission_update/{player.id}", run_after=datetime.now() + timedelta(seconds=delay))
+
+    def deliver_game_mission_updates(self, delivered: Collection[str] = (), on_delivered: Callable[[str], None] = None):
+        """
+        Render the mission sheets of all players at once, and then send the mission updates of all players
+        concurrently. Updates that could not be delivered are queued again for each affected player.
+
+        Each update has a key made of the player ID and the address. Updates whose keys are in delivered are skipped,
+        and on_delivered is called with the key of each update as soon as it has been delivered, so that an interrupted
+        delivery can be resumed without sending any update twice.
+        """
+        assignments = Mission.current_assignments_in_game(self.game)
+
+        missions_by_owner = {}
+        for assignment in assignments:
+            missions_by_owner.setdefault(assignment.owner, []).append(assignment.mission)
+
+        addresses_by_owner = {}
+        for owner in missions_by_owner:
+            addresses = [address for address in owner.notification_addresses
+                         if address.active and f"{owner.id}/{address.address}" not in delivered]
+            if addresses:
+                addresses_by_owner[owner] = addresses
+
+        pdf.generate_mission_sheet_files([m for owner in addresses_by_owner for m in missions_by_owner[owner]])
+
+        messages = []
+        players = []
+        keys = []
+        for owner, addresses in addresses_by_owner.items():
+            paths = pdf.generate_mission_sheet_files(sorted(missions_by_owner[owner], key=lambda m: m.circle_id),
+                                                     progress=None)
+            for address in addresses:
+                messages.append(notification.email.LazyMessage(address.address, functools.partial(
+                    build_mission_update, address.address, paths, self.game.title)))
+                players.append(owner)
+                keys.append(f"{owner.id}/{address.address}")
+
+        report = notification.email.send_messages(
+            messages, on_delivered=(lambda index: on_delivered(keys[index])) if on_delivered else None)
+        print(f"Delivered {sum(r.delivered for r in report)} of {len(report)} mission updates of {self.game.id}")
+        for player, result in zip(players, report):
+            if not result.delivered:
+                print(f"Could not deliver mission update to {result.address}: {result.error}")
+                self.send_mission_update(player, coalesce=False)
+
+    def deliver_mission_update(self, player: str | Player):
         player = self.get_player(player)
         missions = self.get_current_missions(player)
         if missions:
-            for address in player.notification_addresses:
-                if address.active:
-                    notification.email.send_mission_update(address.address, pdf.generate_mission_sheets(missions),
-                                                           self.game.title)
+            addresses = [address for address in player.notification_addresses if address.active]
+            if addresses:
+                mission_sheets = pdf.stream_mission_sheets(missions)
+                with notification.email.delivery_session() as session:
+                    for address in addresses:
+                        notification.email.send_mission_update(address.address, mission_sheets, self.game.title,
+                                                               session=session)
 
     def end_game(self):
         if self.game.state != GameState.running:
             raise GameError("Game is not running")
 
         self.game.state = GameState.ended
+        self.game.bump_revision()
 
     def check_gamemaster_password(self, password) -> bool:
         return self.game.check_gamemaster_password(password)
@@ -207,7 +323,8 @@ class GameService:
 
     @classmethod
     def create_new_game(cls, session: Session, id: str, title: str, gamemaster_password: str,
-                        circles: List[str] = None, **kwargs) -> 'GameService':
+                        circles: List[str] = None, code_scheme: SecretCodeScheme = SecretCodeScheme.v2,
+                        **kwargs) -> 'GameService':
         if Game.exists_by_id(session, id):
             raise GameError(f"A game with ID '{id}' already exists")
 
@@ -216,6 +333,7 @@ class GameService:
             id=id,
             title=title,
             gamemaster_password=gamemaster_password,
+            code_scheme=code_scheme,
             **kwargs
         )
         session.add(game)
@@ -1,32 +1,84 @@
 import os.path
+import subprocess
+import threading
+import time
 
-from moerderspiel.db import Circle, Mission
-from moerderspiel.config import CACHE_DIRECTORY
-from moerderspiel.util import get_circle_color
+from moerderspiel import cache
+from moerderspiel.db import Circle, Game, Mission, database_session
+from moerderspiel.config import CACHE_DIRECTORY, GRAPH_LAYOUT_TIMEOUT, GRAPH_LAYOUT_RETRY_INTERVAL
+from moerderspiel.util import get_circle_color, file_lock, write_file_atomically
 
-from typing import List
+from typing import Callable, Dict, List
+
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
 
 import graphviz
 import hashlib
 
+LAYOUT_ENGINES = ['dot', 'circo', 'neato', 'sfdp']
+
+# The engine used for graphs with up to this many nodes. dot gives the nicest results, but its run time grows so fast
+# that it takes minutes for large games. sfdp is used for all graphs that are larger.
+LAYOUT_ENGINE_MAX_NODES = [(100, 'dot'), (300, 'circo'), (1000, 'neato')]
+
+
+class GraphRenderTimeout(RuntimeError):
+    pass
+
+
+def select_layout_engine(node_count: int) -> str:
+    for max_nodes, engine in LAYOUT_ENGINE_MAX_NODES:
+        if node_count <= max_nodes:
+            return engine
+    return 'sfdp'
 
-def get_circles_graph_cache_path(circles: List[Circle]) -> str:
-    circles_id = circles[0].game.id + '/' + '+'.join([str(c.id) for c in circles])
+
+def get_circles_graph_cache_path(circles: List[Circle], show_original_owners: bool = False, engine: str = 'dot',
+                                 compact: bool = False, latest: bool = False) -> str:
+    """
+    Get the cache path of the graph of the given circles. If latest is True, get the path of the last graph that was
+    rendered for these circles and options, regardless of the revision of the game.
+    """
+    game = circles[0].game
+    revision = 'latest' if latest else (game.revision or 0)
+    circles_id = f"{game.id}/{revision}/{int(show_original_owners)}/{engine}/{int(compact)}/" \
+                 + '+'.join([str(c.id) for c in circles])
     circles_hash = hashlib.sha1(circles_id.encode('utf-8')).hexdigest()
     return os.path.join(CACHE_DIRECTORY, 'graphs', f"{circles_hash}.svg")
 
 
-def generate_circles_graph(circles: List[Circle], show_original_owners: bool = False) -> str:
-    mass_murderers = Mission.mass_murderers_by_game(circles[0].game)
+def _load_game_missions(game: Game) -> List[Mission]:
+    """
+    Load all missions of the game with their victims and killers in a single query, ordered by circle and position.
+    """
+    return game._query(select(Mission).join(Circle).where(Circle.game_id == game.id)
+                       .options(joinedload(Mission.victim), joinedload(Mission.killer))
+                       .order_by(Mission.circle_id, Mission.position)).unique().all()
+
+
+def build_circles_graph(circles: List[Circle], show_original_owners: bool = False,
+                        compact: bool = False) -> graphviz.Digraph:
+    """
+    Build the graph of the given circles. In compact mode, edges are not labelled with how and when the murders
+    happened, which makes the layout of large graphs much faster.
+    """
+    game = circles[0].game
+    missions = _load_game_missions(game)
+    alive = set(m.victim_id for m in missions if not m.completed)
+    mass_murderers = Mission.mass_murderers_by_game(game)
     dot = graphviz.Digraph()
     dot.attr(bgcolor='#00000000')
+    if compact:
+        dot.attr(overlap='false')
 
     for circle in circles:
         color = '#%02x%02x%02x' % get_circle_color(circle)
+        circle_missions = [m for m in missions if m.circle_id == circle.id]
 
-        for mission in circle.missions:
+        for i, mission in enumerate(circle_missions):
             styles = []
-            if not mission.victim.alive:
+            if mission.victim_id not in alive:
                 styles.append('dashed')
             if mission.victim in mass_murderers:
                 styles.append('bold')
@@ -34,7 +86,7 @@ def generate_circles_graph(circles: List[Circle], show_original_owners: bool = F
             dot.node(mission.victim.name, style=', '.join(styles))
 
             if show_original_owners:
-                dot.edge(mission.initial_owner.name, mission.victim.name, style="dashed", color=color)
+                dot.edge(circle_missions[i - 1].victim.name, mission.victim.name, style="dashed", color=color)
 
             if mission.completed:
                 if not mission.killer:
@@ -43,10 +95,172 @@ def generate_circles_graph(circles: List[Circle], show_original_owners: bool = F
                 else:
                     killer = mission.killer.name
 
-                dot.edge(killer, mission.victim.name, color=color,
-                         label=f"{mission.completion_reason}\n({mission.completion_date.strftime('%Y-%m-%d %H:%M')})")
+                if compact:
+                    dot.edge(killer, mission.victim.name, color=color)
+                else:
+                    dot.edge(killer, mission.victim.name, color=color,
+                             label=f"{mission.completion_reason}\n"
+                                   f"({mission.completion_date.strftime('%Y-%m-%d %H:%M')})")
+
+    return dot
 
-    path = get_circles_graph_cache_path(circles)
-    dot.render(format='svg', outfile=path)
+
+def _use_fallback(fallback_path: str) -> str:
+    cache.touch([fallback_path], hit=True)
+    return fallback_path
+
+
+def render_graph(path: str, build: Callable[[], graphviz.Digraph], engine: str = 'dot',
+                 timeout: float = GRAPH_LAYOUT_TIMEOUT, fallback_path: str = None) -> str:
+    """
+    Render the graph returned by build() to the given path, unless the path already exists. Only one process renders
+    a path at a time.
+
+    If there is a graph at fallback_path, which should be the last graph that was rendered successfully, it is
+    returned instead of waiting for a render that is already running, and instead of rendering at all for
+    GRAPH_LAYOUT_RETRY_INTERVAL seconds after a layout took longer than the timeout. It is also returned if the layout
+    times out or fails. Successful renders are stored at fallback_path as well.
+    """
+    has_fallback = fallback_path is not None and os.path.exists(fallback_path)
+    timeout_marker = f"{fallback_path}.timeout" if fallback_path else None
+
+    if has_fallback and not os.path.exists(path):
+        try:
+            if time.time() - os.path.getmtime(timeout_marker) < GRAPH_LAYOUT_RETRY_INTERVAL:
+                return _use_fallback(fallback_path)
+        except FileNotFoundError:
+            pass
+
+    with file_lock(f"{path}.lock", blocking=not has_fallback) as locked:
+        if not locked:
+            return path if os.path.exists(path) else _use_fallback(fallback_path)
+
+        # Another process may have rendered the graph while we were waiting for the lock
+        if not os.path.exists(path):
+            try:
+                svg = subprocess.run([engine, '-Tsvg'], input=build().source.encode('utf-8'), capture_output=True,
+                                     timeout=timeout, check=True).stdout
+            except subprocess.TimeoutExpired:
+                if timeout_marker:
+                    write_file_atomically(timeout_marker, b'')
+                if has_fallback:
+                    return _use_fallback(fallback_path)
+                raise GraphRenderTimeout(f"Layout of {path} with {engine} took more than {timeout} seconds")
+            except subprocess.CalledProcessError as e:
+                print(f"Layout of {path} with {engine} failed: {e.stderr.decode('utf-8', errors='replace')}")
+                if has_fallback:
+                    return _use_fallback(fallback_path)
+                raise
+
+            write_file_atomically(path, svg)
+            if fallback_path:
+                write_file_atomically(fallback_path, svg)
+                if os.path.exists(timeout_marker):
+                    os.remove(timeout_marker)
+            cache.touch([p for p in (path, fallback_path) if p], hit=False)
+            cache.maybe_sweep()
     return path
 
+
+def _prepare_circles_graph(circles: List[Circle], show_original_owners: bool, engine: str, compact: bool):
+    engine = engine or select_layout_engine(len(set(m.victim_id for c in circles for m in c.missions)))
+    path = get_circles_graph_cache_path(circles, show_original_owners, engine, compact)
+    fallback_path = get_circles_graph_cache_path(circles, show_original_owners, engine, compact, latest=True)
+    return engine, path, fallback_path
+
+
+def generate_circles_graph(circles: List[Circle], show_original_owners: bool = False, engine: str = None,
+                           compact: bool = False, timeout: float = GRAPH_LAYOUT_TIMEOUT) -> str:
+    """
+    Render the graph of the given circles, unless it has already been rendered for the current revision of the game.
+    If no layout engine is given, it is selected based on the size of the graph.
+    """
+    engine, path, fallback_path = _prepare_circles_graph(circles, show_original_owners, engine, compact)
+    if os.path.exists(path):
+        cache.touch([path], hit=True)
+        return path
+
+    return render_graph(path, lambda: build_circles_graph(circles, show_original_owners, compact), engine=engine,
+                        timeout=timeout, fallback_path=fallback_path)
+
+
+def get_prerender_lock_path(game_id: str) -> str:
+    game_hash = hashlib.sha1(game_id.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIRECTORY, 'graphs', 'prerender', f"{game_hash}.lock")
+
+
+def prerender_game_graph(game_id: str, show_original_owners: bool = False, engine: str = None,
+                         compact: bool = False) -> None:
+    """
+    Render the graph of all circles of the game in a background thread, so that it is ready by the time someone views
+    it. This must be called after the changes to the game have been committed.
+
+    Only one prerender per game runs at a time across all processes. A prerender that is requested while another one
+    is running is left to that one, which renders the graph again once it is done if the game has changed meanwhile.
+    """
+    threading.Thread(target=_prerender_game_graph, args=(game_id, show_original_owners, engine, compact),
+                     daemon=True).start()
+
+
+def _prerender_game_graph(game_id: str, show_original_owners: bool, engine: str, compact: bool) -> None:
+    with file_lock(get_prerender_lock_path(game_id), blocking=False) as locked:
+        if not locked:
+            return
+
+        while True:
+            with database_session() as session:
+                circles = Circle.by_game(Game.by_id(session, game_id))
+                if not circles:
+                    return
+                selected_engine, path, fallback_path = _prepare_circles_graph(circles, show_original_owners, engine,
+                                                                              compact)
+                if os.path.exists(path):
+                    return
+                # If the layout timed out or failed, or someone else is rendering it, don't try again right away
+                if render_graph(path, lambda: build_circles_graph(circles, show_original_owners, compact),
+                                engine=selected_engine, fallback_path=fallback_path) != path:
+                    return
+
+
+def build_circles_graph_data(game: Game, circles: List[Circle], show_original_owners: bool = False) -> Dict:
+    """
+    Build the graph of the given circles as a JSON-serializable dict, for rendering it in the browser.
+    All missions of the game are loaded with a single query.
+    """
+    missions = _load_game_missions(game)
+
+    alive = set(m.victim_id for m in missions if not m.completed)
+    mass_murderers = set(entry.player.id for entry in Mission.leaderboard_by_game(game, limit=1))
+
+    circle_ids = set(c.id for c in circles)
+    nodes = {}
+    edges = []
+    for circle in circles:
+        circle_missions = [m for m in missions if m.circle_id == circle.id]
+
+        for i, mission in enumerate(circle_missions):
+            nodes.setdefault(mission.victim.name, dict(id=mission.victim.name,
+                                                       alive=mission.victim_id in alive,
+                                                       mass_murderer=mission.victim_id in mass_murderers))
+
+            if show_original_owners:
+                edges.append(dict(type='initial', circle=circle.id, target=mission.victim.name,
+                                  source=circle_missions[i - 1].victim.name))
+
+            if mission.completed:
+                if not mission.killer:
+                    nodes.setdefault('Game Master', dict(id='Game Master', alive=True, mass_murderer=False,
+                                                         game_master=True))
+                edges.append(dict(type='kill', circle=circle.id, target=mission.victim.name,
+                                  source=mission.killer.name if mission.killer else 'Game Master',
+                                  reason=mission.completion_reason,
+                                  date=mission.completion_date.strftime('%Y-%m-%d %H:%M')))
+
+    return dict(
+        game=game.id,
+        revision=game.revision or 0,
+        circles=[dict(id=c.id, name=c.name, color='#%02x%02x%02x' % get_circle_color(c))
+                 for c in game.circles if c.id in circle_ids],
+        nodes=list(nodes.values()),
+        edges=edges,
+    )
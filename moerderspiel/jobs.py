@@ -0,0 +1,97 @@
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+from typing import Callable, Dict
+
+from sqlalchemy.orm import Session
+
+from moerderspiel import config
+from moerderspiel.db import Game, Player, Job, JobKind, database_transaction
+from moerderspiel.game import GameService
+
+
+def record_progress(job_id: int, key: str) -> None:
+    """
+    Record that a part of the job has been done, in a transaction of its own so that it is kept if the job fails.
+    """
+    with database_transaction() as session:
+        Job.record_progress(session, job_id, key)
+
+
+def handle_mission_update(session: Session, job: Job, player_id: int) -> None:
+    player = session.get(Player, player_id)
+    if player:
+        GameService(player.game).deliver_mission_update(player)
+
+
+def handle_game_mission_updates(session: Session, job: Job, game_id: str) -> None:
+    game = session.get(Game, game_id)
+    if game:
+        GameService(game).deliver_game_mission_updates(delivered=job.progress,
+                                                        on_delivered=functools.partial(record_progress, job.id))
+
+
+HANDLERS: Dict[JobKind, Callable[..., None]] = {
+    JobKind.mission_update: handle_mission_update,
+    JobKind.game_mission_updates: handle_game_mission_updates,
+}
+
+
+def run_job(job_id: int) -> bool:
+    """
+    Run the claimed job with the given ID in its own transaction, and record its result. Jobs that enqueue other jobs
+    do so in the same transaction, so the follow-up jobs only exist if the job succeeded.
+    """
+    try:
+        with database_transaction() as session:
+            job = session.get(Job, job_id)
+            HANDLERS[job.kind](session, job, **job.payload)
+            job.finish()
+        return True
+    except Exception as e:
+        print(f"Job {job_id} failed: {type(e).__name__}: {e}")
+        with database_transaction() as session:
+            session.get(Job, job_id).fail(f"{type(e).__name__}: {e}", max_attempts=config.JOB_MAX_ATTEMPTS,
+                                          retry_delay=config.JOB_RETRY_DELAY)
+        return False
+
+
+def run_worker(concurrency: int = config.WORKER_CONCURRENCY, poll_interval: float = config.WORKER_POLL_INTERVAL,
+               once: bool = False) -> None:
+    """
+    Process jobs with up to concurrency threads. Several workers may run at the same time, even in different
+    processes or on different hosts. If once is set, return as soon as no job is due anymore instead of polling.
+
+    The leases of the running jobs are renewed a few times per lease, so that jobs that take longer than the lease are
+    not claimed by another worker while this one is still alive.
+    """
+    lease = timedelta(seconds=config.JOB_LEASE)
+    running = {}
+    last_renewal = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            if len(running) < concurrency:
+                with database_transaction() as session:
+                    job_ids = Job.claim(session, concurrency - len(running), lease)
+                running |= {executor.submit(run_job, job_id): job_id for job_id in job_ids}
+
+            if not running:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            if time.monotonic() - last_renewal >= lease.total_seconds() / 3:
+                try:
+                    with database_transaction() as session:
+                        Job.renew(session, list(running.values()), lease)
+                    last_renewal = time.monotonic()
+                except Exception as e:
+                    print(f"Could not renew the leases of jobs {sorted(running.values())}: {type(e).__name__}: {e}")
+
+            done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                future.result()
@@ -1,11 +1,203 @@
+import asyncio
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from email.message import EmailMessage
-from smtplib import SMTP, LMTP
+from smtplib import SMTP, LMTP, SMTPServerDisconnected, SMTPRecipientsRefused, SMTPResponseException
+from io import BytesIO
+from typing import Callable, Generator, List, NamedTuple, Optional
 
 from moerderspiel import config
 
 
-def send_message(to: str, subject: str, body: str, attachment: bytes = None, attachment_type: str = 'application',
-                 attachment_subtype: str = 'pdf', attachment_filename: str = None):
+class DeliverySession:
+    """
+    A connection to the mail server that is reused for many messages. The connection is opened on the first message,
+    renewed after EMAIL_MAX_MESSAGES_PER_CONNECTION messages, and reopened once if the server has dropped it.
+    """
+
+    def __init__(self):
+        self._connection: Optional[SMTP] = None
+        self._messages = 0
+
+    def _connect(self) -> SMTP:
+        if config.EMAIL_SMTP_HOST.startswith('/'):
+            connection = LMTP(config.EMAIL_SMTP_HOST)
+        else:
+            connection = SMTP(config.EMAIL_SMTP_HOST, port=int(config.EMAIL_SMTP_PORT))
+            connection.starttls()
+            connection.ehlo(config.EMAIL_HELO_HOSTNAME)
+        return connection
+
+    def send(self, msg: EmailMessage) -> None:
+        if self._messages >= config.EMAIL_MAX_MESSAGES_PER_CONNECTION:
+            self.close()
+
+        for retry in (True, False):
+            if self._connection is None:
+                self._connection = self._connect()
+                self._messages = 0
+            try:
+                self._connection.send_message(msg)
+                self._messages += 1
+                return
+            except (SMTPServerDisconnected, ConnectionError):
+                self._connection = None
+                if not retry:
+                    raise
+
+    def close(self) -> None:
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except (SMTPServerDisconnected, OSError):
+                pass
+            finally:
+                self._connection = None
+
+    def __enter__(self) -> 'DeliverySession':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+_sessions: queue.LifoQueue = queue.LifoQueue()
+
+
+@contextmanager
+def delivery_session() -> Generator[DeliverySession, None, None]:
+    """
+    Borrow a delivery session from the pool, or open a new one if all are in use. At most EMAIL_POOL_SIZE idle
+    sessions are kept open afterwards.
+    """
+    try:
+        session = _sessions.get_nowait()
+    except queue.Empty:
+        session = DeliverySession()
+
+    try:
+        yield session
+    except BaseException:
+        # The connection may be in an undefined state
+        session.close()
+        raise
+
+    if _sessions.qsize() < config.EMAIL_POOL_SIZE:
+        _sessions.put(session)
+    else:
+        session.close()
+
+
+class DeliveryResult(NamedTuple):
+    address: str
+    delivered: bool
+    attempts: int
+    error: Optional[str] = None
+
+
+class LazyMessage(NamedTuple):
+    """
+    A message that is only built right before it is sent, e.g. because it has a large attachment.
+    """
+    address: str
+    build: Callable[[], EmailMessage]
+
+
+class RateLimiter:
+    """
+    Spaces out the messages sent to the mail server so that at most rate messages are sent per second.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0.0
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        delay = self._next - now
+        self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def is_temporary_failure(error: Exception) -> bool:
+    """
+    Whether sending may succeed when it is tried again later, i.e. the server answered with a 4xx code or dropped
+    the connection.
+    """
+    if isinstance(error, SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    elif isinstance(error, SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (SMTPServerDisconnected, ConnectionError, TimeoutError))
+
+
+async def deliver_messages(messages: List[EmailMessage | LazyMessage],
+                           concurrency: int = config.EMAIL_CONCURRENCY, rate: float = config.EMAIL_RATE_LIMIT,
+                           max_attempts: int = config.EMAIL_MAX_ATTEMPTS,
+                           retry_delay: float = config.EMAIL_RETRY_DELAY,
+                           on_delivered: Callable[[int], None] = None) -> List[DeliveryResult]:
+    """
+    Send all messages over up to concurrency connections, with at most rate messages per second (0 means no limit).
+    Temporary failures are retried up to max_attempts times with an exponential backoff.
+
+    Lazy messages are only built right before they are sent, so that at most concurrency of them are held in memory at
+    once. Returns a delivery result per message, in the same order. If on_delivered is given, it is called with the
+    index of each message right after the message has been delivered.
+    """
+    loop = asyncio.get_running_loop()
+    limiter = RateLimiter(rate)
+    sessions = asyncio.Queue()
+    for _ in range(concurrency):
+        sessions.put_nowait(DeliverySession())
+
+    async def deliver(index: int, message: EmailMessage | LazyMessage) -> DeliveryResult:
+        address = message.address if isinstance(message, LazyMessage) else message['To']
+        attempt = 0
+        while True:
+            attempt += 1
+            session = await sessions.get()
+            try:
+                if isinstance(message, LazyMessage):
+                    message = await loop.run_in_executor(executor, message.build)
+                await limiter.wait()
+                await loop.run_in_executor(executor, session.send, message)
+                break
+            except Exception as e:
+                # After an error response, the connection is still usable
+                if not isinstance(e, SMTPResponseException):
+                    await loop.run_in_executor(executor, session.close)
+                if not is_temporary_failure(e) or attempt >= max_attempts:
+                    return DeliveryResult(address, False, attempt, f"{type(e).__name__}: {e}")
+            finally:
+                sessions.put_nowait(session)
+            await asyncio.sleep(retry_delay * 2 ** (attempt - 1))
+
+        # Outside of the retry loop, so that a failing callback never causes the message to be sent again
+        if on_delivered:
+            await loop.run_in_executor(executor, on_delivered, index)
+        return DeliveryResult(address, True, attempt)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            return await asyncio.gather(*(deliver(index, message) for index, message in enumerate(messages)))
+        finally:
+            while not sessions.empty():
+                await loop.run_in_executor(executor, sessions.get_nowait().close)
+
+
+def send_messages(messages: List[EmailMessage | LazyMessage], **kwargs) -> List[DeliveryResult]:
+    """
+    Send all messages concurrently from synchronous code. See deliver_messages.
+    """
+    return asyncio.run(deliver_messages(messages, **kwargs))
+
+
+def build_message(to: str, subject: str, body: str, attachment: bytes = None, attachment_type: str = 'application',
+                  attachment_subtype: str = 'pdf', attachment_filename: str = None) -> EmailMessage:
     msg = EmailMessage()
     msg['Subject'] = subject
     msg['From'] = config.EMAIL_FROM
@@ -14,37 +206,45 @@ def send_message(to: str, subject: str, body: str, attachment: bytes = None, att
     if attachment:
         msg.add_attachment(attachment, maintype=attachment_type, subtype=attachment_subtype,
                            filename=attachment_filename)
+    return msg
+
+
+def send_message(to: str, subject: str, body: str, attachment: bytes = None, attachment_type: str = 'application',
+                 attachment_subtype: str = 'pdf', attachment_filename: str = None, session: DeliverySession = None):
+    send(build_message(to, subject, body, attachment, attachment_type, attachment_subtype, attachment_filename),
+         session=session)
 
-    if config.EMAIL_SMTP_HOST.startswith('/'):
-        with LMTP(config.EMAIL_SMTP_HOST) as lmtp:
-            lmtp.send_message(msg)
-            lmtp.quit()
+
+def send(msg: EmailMessage, session: DeliverySession = None):
+    if session:
+        session.send(msg)
     else:
-        with SMTP(config.EMAIL_SMTP_HOST, port=int(config.EMAIL_SMTP_PORT)) as smtp:
-            smtp.starttls()
-            smtp.ehlo(config.EMAIL_HELO_HOSTNAME)
-            smtp.send_message(msg)
-            smtp.quit()
+        with delivery_session() as session:
+            session.send(msg)
 
 
-def send_confirmation_message(address: str, url: str, game_title: str):
+def send_confirmation_message(address: str, url: str, game_title: str, session: DeliverySession = None):
     send_message(
         subject=f"Mörderspiel \"{game_title}\": Adresse bestätigen",
         to=address,
         body=f"Du hast dich für das Mörderspiel \"{game_title}\" angemeldet.\n"
              "Bevor du Benachrichtigungen per E-Mail bekommst, musst du deine E-Mail-Adresse bestätigen.\n"
-             f"Klicke dazu auf den folgenden Link:\n\n{url}"
+             f"Klicke dazu auf den folgenden Link:\n\n{url}",
+        session=session
+    )
+
+
+def build_mission_update(address: str, mission_sheets: BytesIO, game_title: str) -> EmailMessage:
+    return build_message(
+        subject=f"Mörderspiel \"{game_title}\": Neue Aufträge",
+        to=address,
+        body="Im Anhang findest du deine neuen Aufträge.",
+        attachment=mission_sheets.getvalue(),
+        attachment_type='application',
+        attachment_subtype='pdf',
+        attachment_filename='missions.pdf'
     )
 
 
-def send_mission_update(address: str, pdf_path: str, game_title: str):
-    with open(pdf_path, "rb") as file:
-        send_message(
-            subject=f"Mörderspiel \"{game_title}\": Neue Aufträge",
-            to=address,
-            body="Im Anhang findest du deine neuen Aufträge.",
-            attachment=file.read(),
-            attachment_type='application',
-            attachment_subtype='pdf',
-            attachment_filename='missions.pdf'
-        )
+def send_mission_update(address: str, mission_sheets: BytesIO, game_title: str, session: DeliverySession = None):
+    send(build_mission_update(address, mission_sheets, game_title), session=session)
@@ -1,18 +1,124 @@
-from typing import Dict, List
+import functools
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
 
+from pypdf import PdfReader, PdfWriter
+
+from moerderspiel import cache
 from moerderspiel.db import Game, Mission
-from moerderspiel.config import CACHE_DIRECTORY, BASE_URL
+from moerderspiel.config import CACHE_DIRECTORY, BASE_URL, MISSION_SHEET_WORKERS, MISSION_SHEET_BATCH_SIZE, \
+    MISSION_SHEET_LATEX_FORMAT
+from moerderspiel.util import file_lock, write_file_atomically
 
 import os
 import os.path
+import json
+import math
+import re
 import subprocess
 import hashlib
+import tempfile
 
 RESOURCE_DIRECTORY = os.path.dirname(__file__)
 
+# The number of parsed mission sheets that are kept open for merging. Each reader keeps its whole file and the parsed
+# objects in memory, so this covers the sheets that are merged again and again, not whole large games.
+OPEN_MISSION_SHEETS = 64
+
+LATEX_SPECIAL_CHARACTERS = {
+    '\\': r'\textbackslash{}',
+    '&': r'\&',
+    '%': r'\%',
+    '$': r'\$',
+    '#': r'\#',
+    '_': r'\_',
+    '{': r'\{',
+    '}': r'\}',
+    '~': r'\textasciitilde{}',
+    '^': r'\textasciicircum{}',
+}
+LATEX_SPECIAL_CHARACTERS_PATTERN = re.compile('|'.join(re.escape(c) for c in LATEX_SPECIAL_CHARACTERS))
+
+
+def escape_latex(text: str) -> str:
+    return LATEX_SPECIAL_CHARACTERS_PATTERN.sub(lambda m: LATEX_SPECIAL_CHARACTERS[m.group()], str(text))
+
+
+@functools.cache
+def get_mission_sheet_format_path() -> str:
+    """
+    The path of the prebuilt LaTeX format of the mission sheets. It depends on the preamble and the LuaLaTeX version,
+    so a changed preamble or TeX installation never picks up a stale format.
+    """
+    version = subprocess.run(['lualatex', '--version'], capture_output=True, check=True).stdout
+    sources = b''.join(open(os.path.join(RESOURCE_DIRECTORY, name), 'rb').read()
+                       for name in ('mission-format.tex', 'mission-preamble.tex'))
+    format_hash = hashlib.sha1(version + sources).hexdigest()
+    return os.path.join(CACHE_DIRECTORY, 'latex', f"mission-format-{format_hash}.fmt")
+
+
+def build_mission_sheet_format() -> str:
+    dest = get_mission_sheet_format_path()
+
+    with file_lock(f"{dest}.lock"):
+        if not os.path.exists(dest):
+            print(f"Generating mission sheet format {dest}")
+            subprocess.run(os.path.join(RESOURCE_DIRECTORY, 'build-mission-format.sh'),
+                           env={**os.environ, 'destfile': dest}, check=True)
+
+    return dest
+
+
+_format_failed = False
+
+
+def get_mission_sheet_format_env() -> Dict[str, str]:
+    """
+    The environment that makes the build scripts use the prebuilt format, which is built on first use. If the format
+    is disabled or cannot be built, the scripts fall back to compiling the whole preamble with latexmk.
+    """
+    global _format_failed
+    if not MISSION_SHEET_LATEX_FORMAT or _format_failed:
+        return {}
 
-def generate_mission_sheet(mission: Mission) -> str:
-    params = dict(
+    try:
+        return {'formatfile': build_mission_sheet_format()}
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Could not build the mission sheet format, falling back to latexmk: {e}")
+        _format_failed = True
+        return {}
+
+
+@functools.cache
+def get_mission_sheet_layout_revision() -> str:
+    """
+    A hash of everything that determines the layout of a mission sheet besides its parameters. Manifest entries of
+    older layouts are never used.
+    """
+    sources = b''.join(open(os.path.join(RESOURCE_DIRECTORY, name), 'rb').read()
+                       for name in sorted(os.listdir(RESOURCE_DIRECTORY)) if name.endswith(('.tex', '.sh')))
+    return hashlib.sha1(sources + BASE_URL.encode('utf-8')).hexdigest()
+
+
+def get_mission_sheet_key(mission: Mission) -> str:
+    """
+    The manifest key of the mission sheet of the given mission. Unlike the parameters, this needs neither a generated
+    mission code nor a walk through the circle: the hunter link of an uncompleted mission is its current owner. The
+    victim name and the stored code are part of the key, so that a sheet is rendered again when either changes.
+    """
+    if mission.hunter_id is not None and not mission.completed:
+        owner_id = mission.hunter_id
+    else:
+        owner_id = mission.current_owner.id
+    content_hash = hashlib.sha1(f"{mission.victim.name}\0{mission._code}".encode('utf-8')).hexdigest()
+    return (f"mission-sheet/{mission.circle.game_id}/{mission.circle_id}/{mission.victim_id}/{owner_id}/"
+            f"{content_hash}/{get_mission_sheet_layout_revision()}")
+
+
+def get_mission_sheet_params(mission: Mission) -> Dict[str, str]:
+    return dict(
         gameid=mission.game.id,
         missioncode=mission.code,
         owner=mission.current_owner.name,
@@ -21,35 +127,204 @@ def generate_mission_sheet(mission: Mission) -> str:
         headline=(mission.game.title if len(mission.game.circles) == 1 else f"{mission.game.title} - {mission.circle.name}")
     )
 
+
+def get_mission_sheet_path(params: Dict[str, str]) -> str:
     params_string = str(dict(sorted(params.items())))
     params_hash = hashlib.sha1(params_string.encode("utf-8")).hexdigest()
-    dest = os.path.join(CACHE_DIRECTORY, 'mission-sheets', f"{params_hash}.pdf")
+    return os.path.join(CACHE_DIRECTORY, 'mission-sheets', f"{params_hash}.pdf")
 
-    if not os.path.exists(dest):
-        print(f"Generating mission sheet {dest}")
-        subprocess.run(os.path.join(RESOURCE_DIRECTORY, 'build-mission-sheet.sh'),
-                       env={**os.environ, **params, 'destfile': dest})
 
+def render_mission_sheet(params: Dict[str, str], dest: str) -> str:
+    """
+    Render the mission sheet with the given parameters to dest, unless it already exists. Only one process renders
+    a sheet at a time.
+    """
+    with file_lock(f"{dest}.lock"):
+        if not os.path.exists(dest):
+            print(f"Generating mission sheet {dest}")
+            subprocess.run(os.path.join(RESOURCE_DIRECTORY, 'build-mission-sheet.sh'),
+                           env={**os.environ, **get_mission_sheet_format_env(), **params, 'destfile': dest})
     return dest
 
 
-def generate_mission_sheets(missions: List[Mission]) -> str:
-    mission_sheets = []
+def write_mission_sheet_data(path: str, sheets: List[Dict[str, str]]) -> None:
+    """
+    Write the data file for mission-batch.tex, with one \\missionsheet command per sheet.
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        for params in sheets:
+            args = [params[key] for key in ('owner', 'headline', 'victim', 'missioncode', 'gameurl')]
+            file.write('\\missionsheet' + ''.join(f"{{{escape_latex(arg)}}}" for arg in args) + '\n')
+
+
+def extract_page(reader: PdfReader, page: int, dest: str) -> None:
+    """
+    Write the given page (counting from 1) of an open PDF to dest as a single-page PDF.
+    """
+    writer = PdfWriter()
+    writer.add_page(reader.pages[page - 1])
+    data = io.BytesIO()
+    writer.write(data)
+    write_file_atomically(dest, data.getvalue())
+
+
+def render_mission_sheet_batch(sheets: Dict[str, Dict[str, str]]) -> List[str]:
+    """
+    Render several mission sheets, given as a dict from destination path to parameters, in a single LaTeX run.
+    Every sheet takes exactly one page of the batch PDF; the page of each sheet is recorded next to the batch PDF, and
+    the pages are then cut into the individual sheet files. If the batch PDF does not have one page per sheet, e.g.
+    because a name overflowed onto a second page, the sheets are rendered one by one instead.
+    """
+    if len(sheets) == 1:
+        return [render_mission_sheet(params, dest) for dest, params in sheets.items()]
+
+    dests = list(sheets)
+    batch_hash = hashlib.sha1('/'.join(os.path.basename(d) for d in dests).encode('utf-8')).hexdigest()
+    batch = os.path.join(CACHE_DIRECTORY, 'mission-sheets', 'batches', f"{batch_hash}.pdf")
+
+    with file_lock(f"{batch}.lock"):
+        if not os.path.exists(batch):
+            print(f"Generating mission sheet batch {batch} with {len(dests)} sheets")
+            with tempfile.TemporaryDirectory() as tempdir:
+                datafile = os.path.join(tempdir, 'missions.tex')
+                destfile = os.path.join(tempdir, 'mission-batch.pdf')
+                write_mission_sheet_data(datafile, list(sheets.values()))
+                subprocess.run(os.path.join(RESOURCE_DIRECTORY, 'build-mission-batch.sh'),
+                               env={**os.environ, **get_mission_sheet_format_env(), 'datafile': datafile,
+                                    'destfile': destfile}, check=True)
+
+                page_count = len(PdfReader(destfile).pages)
+                if page_count != len(dests):
+                    print(f"Mission sheet batch {batch} has {page_count} pages instead of {len(dests)}, "
+                          f"rendering the sheets one by one")
+                    return [render_mission_sheet(params, dest) for dest, params in sheets.items()]
+
+                with open(destfile, 'rb') as file:
+                    write_file_atomically(batch, file.read())
+
+        pages = {os.path.basename(dest): page for page, dest in enumerate(dests, start=1)}
+        write_file_atomically(batch.replace('.pdf', '.json'), json.dumps(pages).encode('utf-8'))
+        cache.touch([batch, batch.replace('.pdf', '.json')], hit=False)
+
+        # The batch is only parsed once for all of its sheets
+        reader = None
+        for dest in dests:
+            with file_lock(f"{dest}.lock"):
+                if not os.path.exists(dest):
+                    reader = reader or PdfReader(batch)
+                    extract_page(reader, pages[os.path.basename(dest)], dest)
+
+    return dests
+
+
+def print_progress(done: int, total: int) -> None:
+    print(f"Generated {done}/{total} mission sheets")
+
+
+def generate_mission_sheet_files(missions: List[Mission], workers: int = MISSION_SHEET_WORKERS,
+                                 progress: Callable[[int, int], None] = print_progress) -> List[str]:
+    """
+    Generate the mission sheets of all given missions, and return their paths in the same order.
+    Sheets that are not cached yet are split into batches that are each compiled in one LaTeX run, and the batches are
+    rendered concurrently by the given number of workers. Sheets with identical parameters are only rendered once.
+
+    Sheets are found through the cache manifest first, so the parameters are only computed for sheets that are not
+    in the manifest.
+    """
+    keys = [get_mission_sheet_key(mission) for mission in missions]
+    known = cache.lookup(keys)
+
+    sheets = {}
+    paths = []
+    new_keys = {}
+    for mission, key in zip(missions, keys):
+        if key in known:
+            paths.append(known[key])
+            continue
+
+        params = get_mission_sheet_params(mission)
+        dest = get_mission_sheet_path(params)
+        paths.append(dest)
+        new_keys[key] = dest
+        if not os.path.exists(dest):
+            sheets[dest] = params
+
+    cache.touch({p for p in paths if p not in sheets}, hit=True)
+
+    if sheets:
+        # Use as few LaTeX runs as possible, but keep all workers busy
+        batch_size = min(MISSION_SHEET_BATCH_SIZE, math.ceil(len(sheets) / workers))
+        dests = list(sheets)
+        batches = [{dest: sheets[dest] for dest in dests[i:i + batch_size]} for i in range(0, len(dests), batch_size)]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_mission_sheet_batch, batch) for batch in batches]
+            done = 0
+            for future in futures:
+                done += len(future.result())
+                if progress:
+                    progress(done, len(sheets))
+
+        cache.touch(sheets, hit=False)
+        cache.maybe_sweep()
+
+    cache.remember(new_keys)
+    return paths
+
+
+@functools.lru_cache(maxsize=OPEN_MISSION_SHEETS)
+def open_mission_sheet(path: str, mtime: float) -> PdfReader:
+    """
+    Parse the given mission sheet, or return it from the cache. The modification time is part of the cache key, so a
+    replaced file is parsed again.
+    """
+    return PdfReader(path)
+
+
+# Readers load objects lazily from their stream, so they must not be used by several threads at once
+_merge_lock = threading.Lock()
+
+
+def merge_mission_sheets(paths: List[str]) -> io.BytesIO:
+    """
+    Merge the given single-page mission sheets into one PDF in memory. The page objects are copied from the cached
+    readers without being re-encoded.
+    """
+    writer = PdfWriter()
+    with _merge_lock:
+        for path in paths:
+            writer.add_page(open_mission_sheet(path, os.path.getmtime(path)).pages[0])
+
+    result = io.BytesIO()
+    writer.write(result)
+    result.seek(0)
+    return result
+
+
+def stream_mission_sheets(missions: List[Mission], workers: int = MISSION_SHEET_WORKERS) -> io.BytesIO:
+    return merge_mission_sheets(generate_mission_sheet_files(missions, workers=workers))
+
+
+def stream_game_mission_sheets(game: Game, workers: int = MISSION_SHEET_WORKERS) -> io.BytesIO:
+    return stream_mission_sheets([a.mission for a in Mission.current_assignments_in_game(game)], workers=workers)
+
 
-    for mission in missions:
-        mission_sheets.append(generate_mission_sheet(mission))
+def generate_mission_sheets(missions: List[Mission], workers: int = MISSION_SHEET_WORKERS) -> str:
+    mission_sheets = generate_mission_sheet_files(missions, workers=workers)
 
     mission_hashes = [os.path.basename(p).replace('.pdf', '') for p in mission_sheets]
     game_hash = hashlib.sha1('/'.join(mission_hashes).encode('utf-8')).hexdigest()
     dest = os.path.join(CACHE_DIRECTORY, 'mission-sheets', f"{game_hash}.pdf")
 
-    if not os.path.exists(dest):
+    if os.path.exists(dest):
+        cache.touch([dest], hit=True)
+    else:
         print(f"Generating game mission sheet {dest}")
-        subprocess.run(['/usr/bin/pdfunite', *mission_sheets, dest])
+        write_file_atomically(dest, merge_mission_sheets(mission_sheets).getvalue())
+        cache.touch([dest], hit=False)
 
     return dest
 
 
-def generate_game_mission_sheets(game: Game) -> str:
-    missions = sorted(Mission.achievable_missions_in_game(game), key=lambda p: p.current_owner.name)
-    return generate_mission_sheets(missions)
+def generate_game_mission_sheets(game: Game, workers: int = MISSION_SHEET_WORKERS) -> str:
+    return generate_mission_sheets([a.mission for a in Mission.current_assignments_in_game(game)], workers=workers)
@@ -0,0 +1,20 @@
+#!/bin/sh
+set -eu
+
+# Check that all required parameters are set
+: "${datafile?}" "${destfile?}"
+
+readonly sourcedir="$(readlink -f "$(dirname "$0")")"
+readonly tempdir="$(mktemp -d)"
+trap "rm -rf '$tempdir'" EXIT
+
+cd "$tempdir"
+cp "$datafile" "$tempdir/missions.tex"
+# With a prebuilt format, the preamble is already loaded and a single LuaLaTeX pass is enough
+if [ -n "${formatfile:-}" ]; then
+  TEXINPUTS="$sourcedir:" TEXFORMATS="$(dirname "$formatfile"):" lualatex -interaction=batchmode -halt-on-error \
+    -fmt="$(basename "$formatfile" .fmt)" "$sourcedir/mission-batch.tex"
+else
+  TEXINPUTS="$sourcedir:" latexmk -silent -pdf -lualatex "$sourcedir/mission-batch.tex"
+fi
+install -D "$tempdir/mission-batch.pdf" "$destfile"
@@ -0,0 +1,14 @@
+#!/bin/sh
+set -eu
+
+# Check that all required parameters are set
+: "${destfile?}"
+
+readonly sourcedir="$(readlink -f "$(dirname "$0")")"
+readonly tempdir="$(mktemp -d)"
+trap "rm -rf '$tempdir'" EXIT
+
+cd "$tempdir"
+TEXINPUTS="$sourcedir:" lualatex -ini -interaction=batchmode -halt-on-error -jobname=mission-format \
+  '&lualatex' "$sourcedir/mission-format.tex"
+install -D "$tempdir/mission-format.fmt" "$destfile"
@@ -4,10 +4,16 @@ set -eu
 # Check that all required parameters are set
 : "${gameid?}" "${missioncode?}" "${owner?}" "${victim?}" "${gameurl?}" "${headline?}" "${destfile?}"
 
-readonly sourcefile="$(readlink -f "$(dirname "$0")/mission.tex")"
+readonly sourcedir="$(readlink -f "$(dirname "$0")")"
 readonly tempdir="$(mktemp -d)"
 trap "rm -rf '$tempdir'" EXIT
 
 cd "$tempdir"
-latexmk -silent -pdf -lualatex "$sourcefile"
+# With a prebuilt format, the preamble is already loaded and a single LuaLaTeX pass is enough
+if [ -n "${formatfile:-}" ]; then
+  TEXINPUTS="$sourcedir:" TEXFORMATS="$(dirname "$formatfile"):" lualatex -interaction=batchmode -halt-on-error \
+    -fmt="$(basename "$formatfile" .fmt)" "$sourcedir/mission.tex"
+else
+  TEXINPUTS="$sourcedir:" latexmk -silent -pdf -lualatex "$sourcedir/mission.tex"
+fi
 install -D "$tempdir/mission.pdf" "$destfile"
@@ -1,6 +1,11 @@
 import colorsys
+import fcntl
 import itertools
 import math
+import os
+import os.path
+import tempfile
+from contextlib import contextmanager
 from typing import Tuple, Generator
 
 from moerderspiel.db import Circle
@@ -25,3 +30,33 @@ def colorscheme(start_hue: float = 0.86) -> Generator[Tuple[int, int, int], None
 def get_circle_color(circle: Circle) -> Tuple[int, int, int]:
     index_in_game = sorted(circle.game.circles, key=lambda c: c.id).index(circle)
     return next(itertools.islice(colorscheme(), index_in_game, None))
+
+
+@contextmanager
+def file_lock(path: str, blocking: bool = True):
+    """
+    Hold an exclusive lock on the given lock file while in this context. This works across processes, e.g. between
+    multiple gunicorn workers, and blocks until the lock is available. If blocking is False, the context is entered
+    right away and yields whether the lock could be acquired.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def write_file_atomically(path: str, data: bytes) -> None:
+    """
+    Write the file in a way that other processes either see the complete file or no file at all.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as file:
+        file.write(data)
+    os.replace(file.name, path)
@@ -6,7 +6,7 @@ import jwt
 from flask import Flask, render_template, send_from_directory, request, url_for, redirect, flash, abort, session
 from flask_sqlalchemy import SQLAlchemy
 
-from moerderspiel.db import Base, Game, Mission, Circle, Player, NotificationAddressType
+from moerderspiel.db import Base, Game, Mission, Circle, Player, NotificationAddressType, GameStatistics, engine_options
 from moerderspiel import config, graph, pdf, notification
 from moerderspiel.game import GameService, GameError
 from moerderspiel.web.forms import AddPlayerForm, CreateGameForm, RecordMurderForm, GameMasterLoginForm, AddCircleForm
@@ -14,10 +14,13 @@ from moerderspiel.web.forms import AddPlayerForm, CreateGameForm, RecordMurderFo
 app = Flask(__name__)
 app.config.from_prefixed_env()
 app.config["SQLALCHEMY_DATABASE_URI"] = config.DATABASE_URL
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(config.DATABASE_URL)
 app.config["SECRET_KEY"] = config.SECRET_KEY
 db = SQLAlchemy(app, model_class=Base)
-with app.app_context():
-    db.create_all()
+
+
+def prerender_graph(game: Game):
+    graph.prerender_game_graph(game.id, show_original_owners=game.ended)
 
 
 def with_game_service(f):
@@ -97,6 +100,7 @@ def game(service: GameService):
                                       code=record_murder_form.mission_code.data,
                                       reason=record_murder_form.description.data)
                 db.session.commit()
+                prerender_graph(service.game)
                 flash('Mord eingetragen', 'success')
                 return redirect(url_for('game', game_id=service.game.id, _anchor='top'))
             except GameError as e:
@@ -116,7 +120,8 @@ def game(service: GameService):
     return render_template('game.html.j2',
                            game=service.game,
                            completed_missions=Mission.completed_missions_in_game(service.game),
-                           mass_murderers=Mission.mass_murderers_by_game(service.game),
+                           mass_murderers=Mission.leaderboard_by_game(service.game, limit=1),
+                           statistics=GameStatistics.for_game(service.game) if service.game.started else None,
                            add_player_form=add_player_form,
                            record_murder_form=record_murder_form,
                            gamemaster_login_form=gamemaster_login_form)
@@ -138,8 +143,10 @@ def gamemaster(service: GameService):
                 service.delete_player(request.form['player'])
             elif request.form['action'] == 'kick-player':
                 service.kick_player(request.form['player'], datetime.datetime.now(), "Spieler wurde gekickt")
+                db.session.commit()
+                prerender_graph(service.game)
             elif request.form['action'] == 'resend-player-missions':
-                service.send_mission_update(request.form['player'])
+                service.send_mission_update(request.form['player'], coalesce=False)
             elif request.form['action'] == 'delete-circle':
                 service.delete_circle(request.form['circle'])
             db.session.commit()
@@ -158,8 +165,23 @@ def gamemaster(service: GameService):
             except GameError as e:
                 flash(str(e), 'error')
 
+    current_missions = {}
+    statistics = None
+    player_statistics = {}
+    circle_statistics = {}
+    if service.game.started:
+        for assignment in Mission.current_assignments_in_game(service.game):
+            current_missions.setdefault(assignment.owner, []).append(assignment.mission)
+        statistics = GameStatistics.for_game(service.game)
+        player_statistics = GameStatistics.players_by_game(service.game)
+        circle_statistics = GameStatistics.circles_by_game(service.game)
+
     return render_template('gamemaster.html.j2',
                            game=service.game,
+                           current_missions=current_missions,
+                           statistics=statistics,
+                           player_statistics=player_statistics,
+                           circle_statistics=circle_statistics,
                            add_circle_form=add_circle_form)
 
 
@@ -171,7 +193,45 @@ def game_graph(service: GameService):
     else:
         circles = Circle.by_game(service.game)
 
-    return flask.send_file(graph.generate_circles_graph(circles, show_original_owners=service.game.ended))
+    try:
+        return flask.send_file(graph.generate_circles_graph(circles, show_original_owners=service.game.ended,
+                                                            compact='compact' in request.args))
+    except graph.GraphRenderTimeout:
+        abort(503)
+
+
+@app.get('/game/<game_id>/graph.json')
+@with_game_service
+def game_graph_data(service: GameService):
+    if 'circle' in request.args:
+        circles = [service.get_circle(c) for c in request.args.getlist('circle')]
+    else:
+        circles = Circle.by_game(service.game)
+
+    # The graph only changes with the revision of the game, so clients can revalidate without us building it again
+    etag = f"{service.game.id}-{service.game.revision or 0}-{int(service.game.ended)}-" \
+           + '+'.join(str(c.id) for c in circles)
+    if request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.jsonify(graph.build_circles_graph_data(service.game, circles,
+                                                                show_original_owners=service.game.ended))
+    response.set_etag(etag)
+    return response
+
+
+@app.get('/game/<game_id>/graph')
+@with_game_service
+def game_graph_page(service: GameService):
+    return render_template('graph.html.j2', game=service.game)
+
+
+@app.get('/game/<game_id>/leaderboard.json')
+@with_game_service
+def game_leaderboard(service: GameService):
+    limit = request.args.get('limit', type=int)
+    return flask.jsonify([dict(player=entry.player.name, kills=entry.kills)
+                          for entry in Mission.leaderboard_by_game(service.game, limit=limit)])
 
 
 @app.get('/game/<game_id>/wall')
@@ -186,14 +246,16 @@ def game_wall(service: GameService):
 @with_game_service
 @needs_gamemaster_authentication
 def game_missions(service: GameService):
-    return flask.send_file(pdf.generate_game_mission_sheets(service.game))
+    return flask.send_file(pdf.stream_game_mission_sheets(service.game), mimetype='application/pdf',
+                           download_name='missions.pdf')
 
 
 @app.get('/game/<game_id>/missions/<player_name>.pdf')
 @with_game_service
 @needs_gamemaster_authentication  # For now, until player authentication is implemented
 def player_missions(service: GameService, player_name: str):
-    return flask.send_file(pdf.generate_mission_sheets(service.get_current_missions(player_name)))
+    return flask.send_file(pdf.stream_mission_sheets(service.get_current_missions(player_name)),
+                           mimetype='application/pdf', download_name=f"{player_name}.pdf")
 
 
 @app.get('/game')
@@ -209,6 +271,11 @@ def css(path):
     return send_from_directory('static/css', path)
 
 
+@app.route('/js/<path:path>')
+def js(path):
+    return send_from_directory('static/js', path)
+
+
 @app.route('/img/<path:path>')
 def img(path):
     return send_from_directory('static/img', path)
@@ -0,0 +1,127 @@
+// Renders the game graph from graph.json in the browser, so that the server does not have to run graphviz.
+// Nodes are placed on a circle and, for small graphs, relaxed with a simple force-directed layout.
+
+(function () {
+    'use strict';
+
+    const SVG_NS = 'http://www.w3.org/2000/svg';
+    const FORCE_LAYOUT_MAX_NODES = 200;
+    const FORCE_LAYOUT_ITERATIONS = 300;
+
+    function element(name, attributes, parent) {
+        const e = document.createElementNS(SVG_NS, name);
+        for (const [key, value] of Object.entries(attributes)) {
+            e.setAttribute(key, value);
+        }
+        if (parent) {
+            parent.appendChild(e);
+        }
+        return e;
+    }
+
+    function circularLayout(nodes, radius) {
+        nodes.forEach((node, i) => {
+            const angle = 2 * Math.PI * i / nodes.length;
+            node.x = radius * Math.cos(angle);
+            node.y = radius * Math.sin(angle);
+        });
+    }
+
+    function forceLayout(nodes, edges, distance) {
+        for (let iteration = 0; iteration < FORCE_LAYOUT_ITERATIONS; iteration++) {
+            const cooling = 1 - iteration / FORCE_LAYOUT_ITERATIONS;
+            nodes.forEach(node => { node.dx = 0; node.dy = 0; });
+
+            for (let i = 0; i < nodes.length; i++) {
+                for (let j = i + 1; j < nodes.length; j++) {
+                    const a = nodes[i], b = nodes[j];
+                    const dx = a.x - b.x, dy = a.y - b.y;
+                    const d2 = Math.max(dx * dx + dy * dy, 1);
+                    const f = distance * distance / d2;
+                    a.dx += dx * f; a.dy += dy * f;
+                    b.dx -= dx * f; b.dy -= dy * f;
+                }
+            }
+
+            for (const edge of edges) {
+                const dx = edge.target.x - edge.source.x, dy = edge.target.y - edge.source.y;
+                const d = Math.max(Math.sqrt(dx * dx + dy * dy), 1);
+                const f = d / distance;
+                edge.source.dx += dx * f; edge.source.dy += dy * f;
+                edge.target.dx -= dx * f; edge.target.dy -= dy * f;
+            }
+
+            for (const node of nodes) {
+                const d = Math.max(Math.sqrt(node.dx * node.dx + node.dy * node.dy), 1);
+                const step = Math.min(d, distance * cooling);
+                node.x += node.dx / d * step;
+                node.y += node.dy / d * step;
+            }
+        }
+    }
+
+    function render(svg, data) {
+        const nodes = new Map(data.nodes.map(node => [node.id, {...node}]));
+        const colors = new Map(data.circles.map(circle => [circle.id, circle.color]));
+        const edges = data.edges.map(edge => ({...edge, source: nodes.get(edge.source), target: nodes.get(edge.target)}));
+
+        const distance = 80;
+        const radius = Math.max(distance * nodes.size / (2 * Math.PI), distance);
+        circularLayout([...nodes.values()], radius);
+        if (nodes.size <= FORCE_LAYOUT_MAX_NODES) {
+            forceLayout([...nodes.values()], edges, distance);
+        }
+
+        const xs = [...nodes.values()].map(n => n.x), ys = [...nodes.values()].map(n => n.y);
+        const margin = distance;
+        const minX = Math.min(...xs) - margin, minY = Math.min(...ys) - margin;
+        const width = Math.max(...xs) - minX + margin, height = Math.max(...ys) - minY + margin;
+        svg.setAttribute('viewBox', `${minX} ${minY} ${width} ${height}`);
+
+        const defs = element('defs', {}, svg);
+        for (const [id, color] of colors) {
+            const marker = element('marker', {id: `arrow-${id}`, viewBox: '0 0 10 10', refX: 18, refY: 5,
+                markerWidth: 6, markerHeight: 6, orient: 'auto'}, defs);
+            element('path', {d: 'M 0 0 L 10 5 L 0 10 z', fill: color}, marker);
+        }
+
+        for (const edge of edges) {
+            const line = element('line', {x1: edge.source.x, y1: edge.source.y, x2: edge.target.x, y2: edge.target.y,
+                stroke: colors.get(edge.circle), 'marker-end': `url(#arrow-${edge.circle})`,
+                'stroke-dasharray': edge.type === 'initial' ? '4 4' : 'none'}, svg);
+            if (edge.type === 'kill') {
+                element('title', {}, line).textContent = `${edge.reason} (${edge.date})`;
+            }
+        }
+
+        for (const node of nodes.values()) {
+            const group = element('g', {transform: `translate(${node.x}, ${node.y})`}, svg);
+            element('circle', {r: 6, fill: node.game_master ? '#aaaaaa' : 'currentColor',
+                'fill-opacity': node.alive ? 1 : 0.3, stroke: 'currentColor',
+                'stroke-width': node.mass_murderer ? 3 : 1}, group);
+            const label = element('text', {y: -10, 'text-anchor': 'middle', 'font-size': 12, fill: 'currentColor',
+                'font-weight': node.mass_murderer ? 'bold' : 'normal'}, group);
+            label.textContent = node.id;
+        }
+    }
+
+    function renderLegend(legend, data) {
+        for (const circle of data.circles) {
+            const item = document.createElement('span');
+            item.style.color = circle.color;
+            item.style.marginRight = '1em';
+            item.textContent = `● ${circle.name}`;
+            legend.appendChild(item);
+        }
+    }
+
+    document.addEventListener('DOMContentLoaded', () => {
+        const svg = document.getElementById('graph');
+        fetch(svg.dataset.src)
+            .then(response => response.json())
+            .then(data => {
+                renderLegend(document.getElementById('graph-legend'), data);
+                render(svg, data);
+            });
+    });
+})();
@@ -1,5 +1,15 @@
+import enum
+import bisect
 import hashlib
+import hmac
+import itertools
+import os
 import random
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
 from moerderspiel import config
 
 
@@ -8,15 +18,98 @@ class WordGenerator:
     ALIASES = {'ä': 'a', 'ö': 'o', 'ü': 'u', 'ß': 's'}
     WHITESPACE_CHARACTERS = ' \t\n-_.:,;'
 
+    # The compiled transition table consists of this magic string, followed by one row per possible previous
+    # character (None first, then the allowed characters). Each row lists the indices of the possible next characters
+    # in the order in which they first appeared in the corpus (padded with TABLE_PADDING), their counts, and the
+    # cumulative counts. Keeping the order of first appearance makes generated words identical to those generated
+    # from the analyzed corpus.
+    TABLE_MAGIC = b'MSWGTBL1'
+    TABLE_PADDING = 0xff
+    TABLE_ROW = struct.Struct(f"<{len(ALLOWED_CHARACTERS)}B{len(ALLOWED_CHARACTERS)}Q{len(ALLOWED_CHARACTERS)}Q")
+
     def __init__(self, corpus_path: str = None):
         self.weights = {}
+        self._transitions = None
         if corpus_path:
             with open(corpus_path, 'r') as file:
                 self.analyze(file)
 
+    @classmethod
+    def table_cache_path(cls, corpus_path: str) -> str:
+        corpus_id = f"{os.path.realpath(corpus_path)}:{os.stat(corpus_path).st_mtime_ns}"
+        corpus_hash = hashlib.sha1(corpus_id.encode('utf-8')).hexdigest()
+        return os.path.join(config.CACHE_DIRECTORY, 'wordgen', f"{corpus_hash}.table")
+
+    @classmethod
+    def compile_table(cls, corpus_path: str) -> str:
+        """
+        Analyze the corpus and store its compiled transition table in the cache directory.
+        """
+        dest = cls.table_cache_path(corpus_path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(dest), delete=False) as file:
+            file.write(cls(corpus_path=corpus_path).dump_table())
+        os.replace(file.name, dest)
+        return dest
+
+    @classmethod
+    def from_corpus(cls, corpus_path: str) -> 'WordGenerator':
+        """
+        Create a generator for the corpus, using its compiled transition table if it is cached, and caching it
+        otherwise.
+        """
+        try:
+            with open(cls.table_cache_path(corpus_path), 'rb') as file:
+                return cls.load_table(file.read())
+        except (OSError, ValueError):
+            pass
+
+        try:
+            with open(cls.compile_table(corpus_path), 'rb') as file:
+                return cls.load_table(file.read())
+        except OSError:
+            # The cache directory is not writable, so we have to analyze the corpus every time
+            return cls(corpus_path=corpus_path)
+
+    def dump_table(self) -> bytes:
+        characters = type(self).ALLOWED_CHARACTERS
+        result = bytearray(type(self).TABLE_MAGIC)
+
+        for previous in [None, *characters]:
+            weights = self.weights.get(previous, {})
+            padding = len(characters) - len(weights)
+            result += type(self).TABLE_ROW.pack(*[characters.index(c) for c in weights],
+                                                *[type(self).TABLE_PADDING] * padding,
+                                                *weights.values(), *[0] * padding,
+                                                *itertools.accumulate(weights.values()), *[0] * padding)
+
+        return bytes(result)
+
+    @classmethod
+    def load_table(cls, data: bytes) -> 'WordGenerator':
+        characters = cls.ALLOWED_CHARACTERS
+        if not data.startswith(cls.TABLE_MAGIC) \
+                or len(data) != len(cls.TABLE_MAGIC) + (len(characters) + 1) * cls.TABLE_ROW.size:
+            raise ValueError("Not a compiled word generator table")
+
+        generator = cls()
+        transitions = {}
+        rows = cls.TABLE_ROW.iter_unpack(memoryview(data)[len(cls.TABLE_MAGIC):])
+        for previous, row in zip([None, *characters], rows):
+            indices = row[:len(characters)]
+            counts = row[len(characters):2 * len(characters)]
+            weights = {characters[i]: count for i, count in zip(indices, counts) if i != cls.TABLE_PADDING}
+            if weights:
+                generator.weights[previous] = weights
+                transitions[previous] = (list(weights.keys()), list(row[2 * len(characters):][:len(weights)]))
+
+        generator._transitions = transitions
+        return generator
+
     def analyze(self, file):
+        self._transitions = None
         last = None
-        while c := file.read(1):
+        for c in file.read():
             c = str(c).lower()
             c = type(self).ALIASES.get(c, c)
 
@@ -27,24 +120,96 @@ class WordGenerator:
             elif c in type(self).WHITESPACE_CHARACTERS:
                 last = None
 
+    def transitions(self) -> Dict[str | None, Tuple[List[str], List[int]]]:
+        """
+        Get the possible next characters and their cumulative weights for each previous character.
+        """
+        if self._transitions is None:
+            self._transitions = {previous: (list(weights.keys()), list(itertools.accumulate(weights.values())))
+                                 for previous, weights in self.weights.items()}
+        return self._transitions
+
     def next(self, previous: str, rand: random.Random) -> str:
-        return rand.choices(list(self.weights[previous].keys()), self.weights[previous].values(), k=1)[0]
+        population, cum_weights = self.transitions()[previous]
+        return rand.choices(population, cum_weights=cum_weights, k=1)[0]
 
     def generate(self, length: int, seed=None) -> str:
-        rand = random.Random(seed)
+        return self.generate_many([seed], length)[0]
+
+    def generate_many(self, seeds: Iterable, length: int) -> List[str]:
+        """
+        Generate one word for each of the given seeds. This gives the same results as calling generate() for each
+        seed, but is much faster for many seeds.
+        """
+        transitions = self.transitions()
+        result = []
+
+        for seed in seeds:
+            # This is what random.choices() does with cumulative weights, without its per-call overhead
+            rand = random.Random(seed).random
+            characters = []
+            last = None
+            for i in range(length):
+                population, cum_weights = transitions[last]
+                last = population[bisect.bisect(cum_weights, rand() * (cum_weights[-1] + 0.0), 0,
+                                                len(cum_weights) - 1)]
+                characters.append(last)
+            result.append(''.join(characters))
 
-        result = ''
-        last = None
-        for i in range(length):
-            last = self.next(last, rand)
-            result += last
         return result
 
 
-default = WordGenerator(corpus_path=config.WORDGEN_CORPUS)
+default = WordGenerator.from_corpus(config.WORDGEN_CORPUS)
+
+
+class SecretCodeScheme(enum.StrEnum):
+    """
+    The ways in which the seed of a secret code can be derived from the server secret and a salt.
+    Games keep the scheme they were created with, so that their codes never change.
+    """
+
+    """
+    PBKDF2-HMAC-SHA256 with 100000 iterations. This is the scheme of all games created before schemes existed.
+    """
+    v1 = enum.auto()
+
+    """
+    A single HMAC-SHA256. Neither the secret nor the salt is ever seen by players, so there is nothing to gain from
+    key stretching, and deriving a seed is cheap.
+    """
+    v2 = enum.auto()
+
+
+def derive_secret_seed(salt: str, scheme: SecretCodeScheme = SecretCodeScheme.v1) -> bytes:
+    if scheme == SecretCodeScheme.v2:
+        return hmac.digest(config.SECRET_KEY.encode(), salt.encode(), 'sha256')
+    else:
+        return hashlib.pbkdf2_hmac(hash_name='sha256', iterations=100000, password=config.SECRET_KEY.encode(),
+                                   salt=salt.encode())
+
+
+def generate_secret_code(salt: str, length: int, scheme: SecretCodeScheme = SecretCodeScheme.v1) -> str:
+    return default.generate(length, derive_secret_seed(salt, scheme))
+
+
+def generate_secret_codes(salts: List[str], length: int,
+                          scheme: SecretCodeScheme = SecretCodeScheme.v1) -> List[str]:
+    """
+    Generate the secret codes for many salts at once. Deriving v1 seeds is expensive, so it is spread over a pool of
+    processes, one per available CPU core.
+    """
+    if len(salts) <= 1 or scheme != SecretCodeScheme.v1:
+        seeds = [derive_secret_seed(salt, scheme) for salt in salts]
+    else:
+        workers = os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            seeds = list(executor.map(derive_secret_seed, salts, chunksize=max(1, len(salts) // (4 * workers))))
+
+    return default.generate_many(seeds, length)
 
 
-def generate_secret_code(salt: str, length: int) -> str:
-    seed = hashlib.pbkdf2_hmac(hash_name='sha256', iterations=100000, password=config.SECRET_KEY.encode(),
-                               salt=salt.encode())
-    return default.generate(length, seed)
+def check_secret_code(expected: str, actual: str) -> bool:
+    """
+    Compare two secret codes in constant time.
+    """
+    return hmac.compare_digest(expected.encode(), actual.encode())
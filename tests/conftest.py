@@ -0,0 +1,15 @@
+import os
+import tempfile
+
+# moerderspiel.config reads its settings when it is imported, so they have to be set up before any test module
+# imports moerderspiel
+_directory = tempfile.mkdtemp(prefix='moerderspiel-tests-')
+_corpus = os.path.join(_directory, 'corpus.txt')
+with open(_corpus, 'w') as file:
+    file.write('\n'.join(['mord', 'auftrag', 'spiel', 'kreis', 'opfer', 'taeter', 'beweis', 'messer']))
+
+os.environ.setdefault('CACHE_DIRECTORY', os.path.join(_directory, 'cache'))
+os.environ.setdefault('STATE_DIRECTORY', os.path.join(_directory, 'state'))
+os.environ.setdefault('BASE_URL', 'http://localhost')
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ.setdefault('WORDGEN_CORPUS', _corpus)
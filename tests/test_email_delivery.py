@@ -0,0 +1,149 @@
+import queue
+import socketserver
+import threading
+from collections import Counter
+from email.message import EmailMessage
+from typing import List
+
+import pytest
+
+from moerderspiel import config
+from moerderspiel.notification import email
+
+
+class LMTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    A minimal LMTP server on a Unix socket that records which connection delivered each message, and drops the
+    connection after every drop_every messages.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, drop_every: int = 0):
+        super().__init__(path, LMTPHandler)
+        self.drop_every = drop_every
+        self.delivered = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+class LMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self) -> None:
+        with self.server.lock:
+            self.server.connections += 1
+            connection = self.server.connections
+
+        self.reply('220 test ready')
+        recipients = []
+        messages = 0
+        for line in self.rfile:
+            command = line.decode('utf-8').strip()
+            verb = command.split(' ', 1)[0].split(':', 1)[0].upper()
+            if verb == 'LHLO':
+                self.reply('250 test')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip('<> '))
+                self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                for data in self.rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                with self.server.lock:
+                    self.server.delivered += [(connection, recipient) for recipient in recipients]
+                for _ in recipients:
+                    self.reply('250 delivered')
+                messages += 1
+                if self.server.drop_every and messages % self.server.drop_every == 0:
+                    return
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    servers = []
+
+    def start(drop_every: int = 0) -> LMTPServer:
+        lmtp = LMTPServer(str(tmp_path / f"lmtp{len(servers)}.sock"), drop_every)
+        threading.Thread(target=lmtp.serve_forever, daemon=True).start()
+        monkeypatch.setattr(config, 'EMAIL_SMTP_HOST', lmtp.server_address)
+        servers.append(lmtp)
+        return lmtp
+
+    monkeypatch.setattr(email, '_sessions', queue.LifoQueue())
+    yield start
+    for lmtp in servers:
+        lmtp.shutdown()
+        lmtp.server_close()
+
+
+def build_messages(count: int) -> List[EmailMessage]:
+    messages = []
+    for i in range(count):
+        msg = EmailMessage()
+        msg['Subject'] = f"Test {i}"
+        msg['From'] = 'game@example.org'
+        msg['To'] = f"player{i}@example.org"
+        msg.set_content('Test')
+        messages.append(msg)
+    return messages
+
+
+def test_session_reconnects_after_drop(server):
+    lmtp = server(drop_every=3)
+    messages = build_messages(10)
+
+    with email.DeliverySession() as session:
+        for msg in messages:
+            session.send(msg)
+
+    assert sorted(recipient for _, recipient in lmtp.delivered) == sorted(msg['To'] for msg in messages)
+    assert lmtp.connections == 4
+    assert all(count <= 3 for count in Counter(connection for connection, _ in lmtp.delivered).values())
+
+
+def test_session_renews_connection(server, monkeypatch):
+    monkeypatch.setattr(config, 'EMAIL_MAX_MESSAGES_PER_CONNECTION', 4)
+    lmtp = server()
+
+    with email.DeliverySession() as session:
+        for msg in build_messages(10):
+            session.send(msg)
+
+    assert len(lmtp.delivered) == 10
+    assert sorted(Counter(connection for connection, _ in lmtp.delivered).values()) == [2, 4, 4]
+
+
+def test_pool_reuses_sessions(server):
+    lmtp = server()
+
+    for msg in build_messages(5):
+        email.send(msg)
+
+    assert len(lmtp.delivered) == 5
+    assert lmtp.connections == 1
+
+
+def test_send_messages_over_dropped_connections(server):
+    lmtp = server(drop_every=4)
+    messages = build_messages(20)
+
+    report = email.send_messages(messages, concurrency=2, retry_delay=0)
+
+    assert all(result.delivered for result in report)
+    assert sorted(recipient for _, recipient in lmtp.delivered) == sorted(msg['To'] for msg in messages)
+    # Each of the two sessions reuses its connection until the server drops it, and may end with a partly used one
+    counts = Counter(connection for connection, _ in lmtp.delivered)
+    assert all(count <= 4 for count in counts.values())
+    assert lmtp.connections <= len(messages) // 4 + 2
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from moerderspiel import config
+from moerderspiel.db import Game, Mission, database_transaction, init_database
+from moerderspiel.game import GameService
+
+START = datetime(2030, 1, 1)
+
+
+@pytest.fixture
+def game_id(tmp_path):
+    config.DATABASE_URL = f"sqlite:///{tmp_path / 'test.db'}"
+    init_database()
+    with database_transaction() as session:
+        service = GameService.create_new_game(session, id='test', title='Test', gamemaster_password='test',
+                                              circles=['Kreis'])
+        players = [service.add_player(name=name, group='') for name in ['A', 'B', 'C']]
+        service.flush_changes()
+        for player in players:
+            service.add_player_to_circle(player, 'Kreis')
+        service.start_game()
+    return 'test'
+
+
+def record_next_murder(game_id: str, when: datetime) -> str:
+    with database_transaction() as session:
+        service = GameService(Game.by_id(session, game_id))
+        circle = service.game.circles[0]
+        mission = [m for m in circle.missions if not m.completed][0]
+        service.record_murder(mission.current_owner, mission.victim, circle, when, 'Test', None)
+        return mission.victim.name
+
+
+def test_backdated_murder_of_last_player(game_id):
+    # Two murders leave one player alive, who is then killed by the last victim before that victim died
+    record_next_murder(game_id, START + timedelta(hours=1))
+    last_victim = record_next_murder(game_id, START + timedelta(hours=3))
+
+    with database_transaction() as session:
+        service = GameService(Game.by_id(session, game_id))
+        circle = service.game.circles[0]
+        survivor = [m for m in circle.missions if not m.completed][0]
+        service.record_murder(last_victim, survivor.victim, circle, START + timedelta(hours=2), 'Test', None)
+
+    with database_transaction() as session:
+        missions = Game.by_id(session, game_id).circles[0].missions
+        assert all(m.completed for m in missions)
+        assert all(m.hunter_id is not None for m in missions)
+        for mission in missions:
+            assert mission.get_next_uncompleted() is None
+            assert mission.get_previous_uncompleted() is None
+
+    # Backfilling the links must not fail on, or change, a circle without uncompleted missions
+    with database_transaction() as session:
+        service = GameService(Game.by_id(session, game_id))
+        links = [(m.hunter_id, m.target_id) for m in service.game.circles[0].missions]
+        service.link_circle(service.game.circles[0])
+        assert [(m.hunter_id, m.target_id) for m in service.game.circles[0].missions] == links
+
+
+def test_links_follow_uncompleted_missions(game_id):
+    victim = record_next_murder(game_id, START + timedelta(hours=1))
+
+    with database_transaction() as session:
+        missions = Game.by_id(session, game_id).circles[0].missions
+        alive = [m for m in missions if not m.completed]
+        assert len(alive) == 2
+        for mission in missions:
+            expected = [m for m in alive if m is not mission]
+            if mission.victim.name == victim:
+                expected = alive
+            assert mission.get_next_uncompleted() in expected
+            assert mission.get_previous_uncompleted() in expected